@@ -6,5 +6,6 @@ setup(name='pptools',
       author='me',
       author_email='example@example.comq',
       url='https://pptools.tangledhelix.com/',
-      install_requires=['Flask', 'WTForms', 'lxml', 'tinycss', 'cssselect', 'cssutils', 'roman' ],
+      python_requires='>=3.7',
+      install_requires=['Flask>=2.2', 'WTForms', 'lxml', 'tinycss', 'cssselect', 'cssutils', 'roman' ],
      )
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Benchmark of comp_pp.
+
+Times each stage of CompPP.do_process() and simple_html() on the books
+of data/testfiles, then on books of several sizes, made with random
+words of a test file. The samples of data/testfiles are mostly the PG
+header, and repeating them would repeat their ids too. Each case runs
+in its own process, so the peak memory is its own. The results are
+written as JSON, and can be compared to those of a previous run:
+
+  ./bench_comp_pp.py --output new.json --compare old.json
+
+Unknown options are given to comp_pp, e.g. --diff-backend dwdiff.
+"""
+
+import os
+import re
+import sys
+import io
+import json
+import time
+import random
+import textwrap
+import itertools
+import argparse
+import platform
+import subprocess
+import tempfile
+import multiprocessing
+from contextlib import redirect_stdout
+from concurrent.futures import ProcessPoolExecutor
+
+from comp_pp import CompPP, build_parser
+from helpers.timings import peak_memory
+
+TESTFILES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                         "..", "data", "testfiles")
+
+# The cases: a name, the files of the book, and whether to run
+# simple_html() instead of do_process().
+CASES = [
+    ("html-txt", ["book-h.htm", "book.txt"], False),
+    ("simple-html", ["book-h.htm", "book-h.htm"], True),
+]
+
+# The same, on the books of data/testfiles. They have no size.
+TESTFILE_CASES = [
+    ("html-txt", ["34332-h.htm", "pg34332.txt"], False),
+    ("simple-html", ["41307-h.htm", "41307-h.htm"], True),
+]
+
+WORD_RE = re.compile(r"[^\W\d_]+(?:'[^\W\d_]+)?")
+START_RE = re.compile(r"\*\*\* START OF .*?\*\*\*(.*)\*\*\* END OF", re.DOTALL)
+
+# The number of different words in a book.
+BOOK_WORDS = 10000
+
+BOOK_HEAD = """<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN">
+<html>
+<head>
+  <meta http-equiv="content-type" content="text/html; charset=UTF-8">
+  <title>The Project Gutenberg eBook of Benchmark, by comp_pp</title>
+  <style type="text/css">
+    .pagenum {position: absolute; right: 2%;}
+    .smcap {font-variant: small-caps;}
+  </style>
+</head>
+<body>
+"""
+
+
+def make_book(size, directory, seed=0):
+    """Write a book of about size MB as an html file and as a text
+    file, with words made from the text of data/testfiles/pg34332.txt,
+    and return their names.
+
+    The html has chapters, page numbers, italics, small caps and
+    footnotes, all with their own ids, and the text has the usual PG
+    markup for them. Some words differ between the two."""
+    with open(os.path.join(TESTFILES, "pg34332.txt"), "rb") as f:
+        text = f.read().decode("latin-1")
+    m = START_RE.search(text)
+    words = sorted(set(word.lower() for word in WORD_RE.findall(m.group(1) if m else text)))
+
+    # A vocabulary the size of a book's, with more words made of two
+    # halves of the others, and used with Zipf's law like in a text.
+    rng = random.Random(seed)
+    vocabulary = set(words)
+    while len(vocabulary) < BOOK_WORDS:
+        word1, word2 = rng.choice(words), rng.choice(words)
+        vocabulary.add(word1[:len(word1) // 2 + 1] + word2[len(word2) // 2:])
+    words = sorted(vocabulary)
+    rng.shuffle(words)
+    weights = list(itertools.accumulate(1 / rank for rank in range(1, len(words) + 1)))
+
+    html = [BOOK_HEAD]
+    txt = []
+    length = 0
+    chapter = page = footnote = 0
+
+    while length < size * 1024 * 1024:
+        start = len(html)
+        if chapter == 0 or rng.random() < 0.02:
+            chapter += 1
+            html.append('\n<h2><a id="chap{0}"></a>CHAPITRE {0}.</h2>\n'.format(chapter))
+            txt.append("\n\n\nCHAPITRE {0}.\n\n".format(chapter))
+
+        html_words = []
+        txt_words = []
+        notes = []
+        for i in range(rng.randint(20, 150)):
+            word = rng.choices(words, cum_weights=weights)[0]
+            if i == 0:
+                word = word.capitalize()
+            txt_word = word
+            if rng.random() < 0.01:
+                # A typo on one side.
+                txt_word = word[::-1]
+
+            r = rng.random()
+            if r < 0.03:
+                html_words.append("<i>" + word + "</i>")
+                txt_words.append("_" + txt_word + "_")
+            elif r < 0.04:
+                html_words.append('<span class="smcap">' + word.capitalize() + "</span>")
+                txt_words.append(txt_word.upper())
+            elif r < 0.045:
+                footnote += 1
+                note = " ".join(rng.choices(words, cum_weights=weights, k=rng.randint(5, 40)))
+                html_words.append('{0}<a id="FNanchor_{1}" href="#Footnote_{1}" '
+                                  'class="fnanchor">[{1}]</a>'.format(word, footnote))
+                txt_words.append("{0}[{1}]".format(txt_word, footnote))
+                notes.append((footnote, note))
+            else:
+                html_words.append(word)
+                txt_words.append(txt_word)
+
+        if length // 3000 >= page:
+            page += 1
+            html.append('<p><span class="pagenum"><a id="Page_{0}">[{0}]</a>'
+                        '</span>\n'.format(page))
+        else:
+            html.append("<p>")
+        html.append(" ".join(html_words) + ".</p>\n")
+        txt.append(textwrap.fill(" ".join(txt_words) + ".", 72) + "\n\n")
+
+        for number, note in notes:
+            html.append('<div class="footnote"><p>'
+                        '<a id="Footnote_{0}" href="#FNanchor_{0}">'
+                        '<span class="label">[{0}]</span></a> '
+                        '{1}.</p></div>\n'.format(number, note))
+            txt.append(textwrap.fill("[Footnote {0}: {1}.]".format(number, note), 72) + "\n\n")
+
+        length += sum(len(part) for part in html[start:])
+
+    html.append("</body>\n</html>\n")
+
+    names = []
+    for name, parts in (("book-h.htm", html), ("book.txt", txt)):
+        name = os.path.join(directory, name)
+        with open(name, "w", encoding="utf-8") as f:
+            f.write("".join(parts))
+        names.append(name)
+    return names
+
+
+def label(size):
+    if size is None:
+        return "testfile"
+    return "{0:g} MB".format(size)
+
+
+def run_case(filenames, simple_html, options):
+    """Run comp_pp once, in a worker process. Returns the total wall
+    time, the peak memory of the process and the stages."""
+    args = build_parser().parse_args(filenames + options)
+    x = CompPP(args)
+
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        if simple_html:
+            x.simple_html()
+        else:
+            x.do_process()
+    wall = time.perf_counter() - start
+
+    return wall, peak_memory(), [{"stage": stage.name,
+                                  "detail": stage.detail,
+                                  "wall": stage.wall,
+                                  "cpu": stage.cpu,
+                                  "rss_start_mb": stage.rss_start,
+                                  "rss_end_mb": stage.rss_end,
+                                  "process_peak_growth_mb": stage.peak_growth}
+                                 for stage in x.timings.stages]
+
+
+def run_in_process(filenames, simple_html, options):
+    # A new process for each run.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_case, filenames, simple_html, options).result()
+
+
+def bench_case(name, size, filenames, simple_html, repeat, options):
+    """Run a case repeat times, and keep the fastest run."""
+    runs = [run_in_process(filenames, simple_html, options)
+            for i in range(repeat)]
+    wall, peak, stages = min(runs, key=lambda run: run[0])
+
+    print("{0:<12} {1:>8} {2:>9.3f} s".format(name, label(size), wall), file=sys.stderr)
+
+    return {
+        "case": name,
+        "size_mb": size,
+        "bytes": [os.path.getsize(f) for f in filenames],
+        "walls": [run[0] for run in runs],
+        "wall": wall,
+        "peak_mb": peak,
+        "stages": stages,
+    }
+
+
+def bench(sizes, repeat, options, directory):
+    results = []
+
+    for name, files, simple_html in TESTFILE_CASES:
+        filenames = [os.path.join(TESTFILES, f) for f in files]
+        results.append(bench_case(name, None, filenames, simple_html, repeat, options))
+
+    for size in sizes:
+        make_book(size, directory)
+
+        for name, files, simple_html in CASES:
+            filenames = [os.path.join(directory, f) for f in files]
+            results.append(bench_case(name, size, filenames, simple_html, repeat, options))
+
+    return results
+
+
+def commit():
+    """The current commit, if in a git repository."""
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Print the wall time of each case, against a previous run."""
+    before = {(r["case"], r["size_mb"]): r["wall"] for r in old["results"]}
+    print("{0:<12} {1:>8} {2:>10} {3:>10} {4:>7}".format(
+        "case", "size", "before", "after", "ratio"))
+    for result in new["results"]:
+        key = (result["case"], result["size_mb"])
+        if key not in before:
+            continue
+        print("{0:<12} {1:>8} {2:>10.3f} {3:>10.3f} {4:>7.2f}".format(
+            result["case"], label(result["size_mb"]), before[key], result["wall"],
+            result["wall"] / before[key] if before[key] else 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark of comp_pp.')
+    parser.add_argument('--sizes', type=str, default="1,10,50",
+                        help="Sizes of the books, in MB (default: 1,10,50)")
+    parser.add_argument('--repeat', type=int, default=1,
+                        help="Run each case that many times, and keep the fastest")
+    parser.add_argument('--output', type=str, default=None,
+                        help="Write the results in this JSON file, instead of stdout")
+    parser.add_argument('--compare', type=str, default=None,
+                        help="Compare with the results of a previous run")
+
+    args, options = parser.parse_known_args()
+    sizes = [float(size) for size in args.sizes.split(",") if size]
+
+    with tempfile.TemporaryDirectory() as directory:
+        results = bench(sizes, args.repeat, options, directory)
+
+    report = {
+        "commit": commit(),
+        "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "options": options,
+        "results": results,
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    else:
+        json.dump(report, sys.stdout, indent=1)
+        print()
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
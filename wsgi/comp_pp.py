@@ -22,16 +22,23 @@
 
 import re
 import os
+import sys
+import io
 import argparse
-import tempfile
+import signal
+import queue
 import subprocess
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
 from lxml import etree
-import tinycss
-import cssselect
-#from functools import partial
 
 from helpers.exfootnotes import extract_footnotes_pp
 from helpers import sourcefile
+from helpers import worddiff
+from helpers.cache import DiskCache, file_digest, options_digest
+from helpers.timings import Timings
+from helpers.transformcss import clear_element, compile_transform_css, apply_css
 
 DEFAULT_TRANSFORM_CSS = '''
                 i:before, cite:before, em:before, abbr:before, dfn:before,
@@ -54,22 +61,220 @@ DEFAULT_TRANSFORM_CSS = '''
                 div[class^="pagenum"] { display: none }
             '''
 
-def clear_element(element):
-    """In an XHTML tree, remove all sub-elements of a given element.
 
-    We can't properly remove an XML element while traversing the
-    tree. But we can clean it. Remove its text and children. However
-    the tail must be preserved because it belongs to the next element,
-    so re-attach."""
-    tail = element.tail
-    element.clear()
-    element.tail = tail
+class CharNormalizer(object):
+    """Character conversions applied to a text before diffing it.
+
+    Instead of one pass per conversion, they are grouped into at most
+    three passes, in that order: the replacements of several
+    characters (e.g. "[oe]"), a single str.translate() for all the
+    single character replacements, then one regex for all the
+    substitutions. The replacements must not chain, i.e. the result of
+    one must not be replaced by another.
+    """
+
+    def __init__(self):
+        self.sequences = {}
+        self.table = {}
+        self.regexes = []
+        self.compiled = None
+
+    def replace(self, old, new):
+        """Replace every old string with new."""
+        if len(old) == 1:
+            self.table.setdefault(ord(old), new)
+        else:
+            self.sequences.setdefault(old, new)
+        self.compiled = None
+
+    def sub(self, regex, func):
+        """Replace each match of a regex (without groups) with the
+        result of func(matched string)."""
+        self.regexes.append((regex, func))
+        self.compiled = None
+
+    def compile(self):
+        passes = []
+
+        if self.sequences:
+            sequences = dict(self.sequences)
+            seq_regex = re.compile("|".join(re.escape(x) for x in sequences))
+            passes.append(lambda text: seq_regex.sub(lambda m: sequences[m.group()], text))
+
+        if self.table:
+            table = dict(self.table)
+            passes.append(lambda text: text.translate(table))
+
+        if self.regexes:
+            funcs = {}
+            alternatives = []
+            for i, (regex, func) in enumerate(self.regexes):
+                funcs["r" + str(i)] = func
+                alternatives.append("(?P<r{0}>{1})".format(i, regex))
+            sub_regex = re.compile("|".join(alternatives))
+            passes.append(lambda text: sub_regex.sub(lambda m: funcs[m.lastgroup](m.group()), text))
+
+        self.compiled = passes
+
+    def __call__(self, text):
+        if self.compiled is None:
+            self.compile()
+        for func in self.compiled:
+            text = func(text)
+        return text
+
+
+# Cleanup of the text files, in the order it is done. Each rule is
+# (flags, trigger, regex, replacement), and is used when all its flags
+# are set (see pgdp_file_text.cleanup_flags). Every match of the regex
+# contains the trigger, so a rule is skipped when its trigger is not in
+# the text. A rule without regex replaces its trigger. A rule may have
+# a fifth item, a separator that no match contains; then the regex only
+# searches the runs of text between separators containing the
+# trigger. Rules grouped in a tuple are done in a single pass; only
+# rules that can't interact are grouped, so the result is the same as
+# applying them one by one.
+TXT_CLEANUP_RULES = [
+    # Proofers
+    ({"rounds"}, "-----File: ", r"-----File: \w+.png.*", ''),
+
+    # Markup
+    ({"best", "rounds"}, "\n/*\n", None, '\n\n'),
+    ({"best", "rounds"}, "\n*/\n", None, '\n\n'),
+    ({"best", "rounds"}, "\n/#\n", None, '\n\n'),
+    ({"best", "rounds"}, "\n#/\n", None, '\n\n'),
+    ({"best", "rounds"}, "\n/P\n", None, '\n\n'),
+    ({"best", "rounds"}, "\nP/\n", None, '\n\n'),
+
+    ({"best", "rounds", "ignore_format"}, "<i>", None, ''),
+    ({"best", "rounds", "ignore_format"}, "</i>", None, ''),
+    ({"best", "rounds", "keep_format"}, "<i>", None, '_'),
+    ({"best", "rounds", "keep_format"}, "</i>", None, '_'),
+
+    # Once done, no "</...>" is left either.
+    ({"best", "rounds"}, "<", r"<.*?>", ''),
+    ({"best", "rounds"}, "[Blank Page]", None, ''),
+
+    ({"best", "rounds", "proofers_notes"}, "[**", r"\[\*\*[^]]*?\]", ''),
+
+    # A match can't start inside a word, but without the lookbehind
+    # the regex would try from every letter.
+    ({"best", "rounds", "regroup"}, "-*", r"(?<!\w)(\w+)-\*(\n+)\*", r'\2\1', " "),
+    ({"best", "rounds", "regroup"}, "-*", r"(?<!\w)(\w+)-\*_(\n\n)_\*", r'\2\1', " "),
+    ({"best", "rounds", "regroup"}, "-*", r"(?<!\w)(\w+)-\*(\w+)", r'\1\2', " "),
+
+    ({"best", "pp", "ignore_format"}, "_", None, ''),
+
+    # Horizontal separation
+    ({"best", "pp"}, "*       *       *       *       *", None, ''),
+    ({"best", "pp"}, "*     *     *     *     *", None, ''),
+
+    # [Footnote, [Illustrations and [Sidenote tags
+    (({"best", "footnote_tags"}, "[Footnote ", r"\[Footnote (\d+): ", r'\1 '),
+     ({"best", "footnote_tags"}, "*[Footnote: ", None, '')),
+    ({"best", "illustration_tags"}, "[Illustration", r"\[Illustrations?:([^]]*?)\]", r'\1'),
+    ({"best", "illustration_tags"}, "[Illustration]", None, ''),
+    ({"best", "sidenote_tags"}, "[Sidenote:", r"\[Sidenote:([^]]*?)\]", r'\1'),
+
+    # Real mdash
+    ({"best"}, "--", None, "—"),
+]
+
+
+@functools.lru_cache(maxsize=None)
+def compile_txt_cleanup(flags):
+    """Return the passes to clean a text for a set of flags, as a list
+    of (triggers, compiled regex or None, replacement, separator)."""
+    passes = []
+
+    for group in TXT_CLEANUP_RULES:
+        if isinstance(group[0], set):
+            group = (group,)
+        rules = [rule for rule in group if rule[0] <= flags]
+
+        if not rules:
+            continue
+
+        triggers = tuple(rule[1] for rule in rules)
+
+        if len(rules) == 1:
+            _, _, regex, repl = rules[0][:4]
+            separator = rules[0][4] if len(rules[0]) > 4 else None
+            if regex is not None:
+                regex = re.compile(regex)
+            passes.append((triggers, regex, repl, separator))
+            continue
+
+        # Put each regex in its own group, and shift the group numbers
+        # in its replacement. The matching rule is then given by
+        # lastindex.
+        alternatives = []
+        templates = {}
+        index = 1
+        for _, trigger, regex, repl in rules:
+            if regex is None:
+                regex = re.escape(trigger)
+            alternatives.append("(" + regex + ")")
+            templates[index] = re.sub(r"\\(\d+)",
+                                      lambda m: r"\g<{0}>".format(index + int(m.group(1))),
+                                      repl)
+            index += 1 + re.compile(regex).groups
+
+        regex = re.compile("|".join(alternatives))
+        passes.append((triggers, regex,
+                       lambda m, templates=templates: m.expand(templates[m.lastindex]),
+                       None))
+
+    return passes
+
+
+def txt_cleanup(text, flags):
+    """Clean a text with the rules matching the flags."""
+    for triggers, regex, repl, separator in compile_txt_cleanup(flags):
+        if not any(trigger in text for trigger in triggers):
+            continue
+        if regex is None:
+            text = text.replace(triggers[0], repl)
+        elif separator is None:
+            text = regex.sub(repl, text)
+        else:
+            text = sub_around(regex, repl, text, triggers[0], separator)
+    return text
+
+
+def sub_around(regex, repl, text, trigger, separator):
+    """Same as regex.sub(repl, text), when every match contains the
+    trigger and no match contains the separator. Only the runs of text
+    between separators that contain the trigger are searched."""
+    out = []
+    last = 0
+    pos = text.find(trigger)
+    while pos != -1:
+        # text[last] is a separator, unless last is 0.
+        start = text.rfind(separator, last, pos) + 1
+        end = text.find(separator, pos)
+        if end == -1:
+            end = len(text)
+        out.append(text[last:start])
+        out.append(regex.sub(repl, text[start:end]))
+        last = end
+        pos = text.find(trigger, end)
+    out.append(text[last:])
+    return "".join(out)
 
 
 class pgdp_file(object):
     """Stores and process a DP/text/html file.
     """
 
+    # Options used by prepare(). Its result can be cached for a
+    # given file and these options.
+    options = ['extract_footnotes']
+
+    # What is needed from the file once prepared.
+    state = ['text', 'footnotes', 'chars', 'has_oe_ligature',
+             'has_oe_dp', 'start_line', 'convert_errors']
+
     def __init__(self, args):
         self.text = None
         self.words = None
@@ -84,7 +289,11 @@ class pgdp_file(object):
         # Conversion to latin1 ?
         self.convert_to_latin1 = False
 
-        self.transform_func = []
+        # Character conversions decided after comparing both files.
+        self.normalizer = CharNormalizer()
+
+        # Set of the characters in char_text
+        self.chars = set()
 
         # Footnotes, if extracted
         self.footnotes = ""
@@ -92,6 +301,54 @@ class pgdp_file(object):
         # First line of the text. This is where <body> is for html.
         self.start_line = 0
 
+        # Errors returned by convert()
+        self.convert_errors = ""
+
+
+    def prepare(self, filename, timings=None):
+        """Do all the processing that doesn't depend on the other
+        file, up to the text to transform. The stages are recorded in
+        timings if given."""
+        if timings is None:
+            timings = Timings()
+        basename = os.path.basename(filename)
+
+        with timings.stage("load", basename):
+            self.load(filename)
+
+        with timings.stage("analyze", basename):
+            self.process_args(self.args)
+            self.analyze()
+
+            self.chars = set(self.char_text)
+
+        with timings.stage("convert", basename):
+            self.convert_errors = self.convert() or ""
+
+        if self.args.extract_footnotes:
+            with timings.stage("extract_footnotes", basename):
+                self.extract_footnotes()
+
+        with timings.stage("to_text", basename):
+            self.to_text()
+
+
+    def get_state(self):
+        """Return the result of prepare(), in a form that can be
+        pickled."""
+        state = {name: getattr(self, name) for name in self.state}
+        state['basename'] = self.myfile.basename
+        state['encoding'] = self.myfile.encoding
+        return state
+
+
+    def set_state(self, state):
+        """Restore the result of prepare()."""
+        for name in self.state:
+            setattr(self, name, state[name])
+        self.myfile.basename = state['basename']
+        self.myfile.encoding = state['encoding']
+
 
     def load(self, filename):
         pass
@@ -107,6 +364,10 @@ class pgdp_file(object):
         """Extract the footnotes."""
         pass
 
+    def to_text(self):
+        """Get the text to diff."""
+        pass
+
     def transform(self):
         """Final transformation pass."""
         pass
@@ -116,6 +377,11 @@ class pgdp_file(object):
 
 class pgdp_file_text(pgdp_file):
 
+    options = pgdp_file.options + [
+        'txt_cleanup_type', 'ignore_format', 'suppress_proofers_notes',
+        'regroup_split_words', 'suppress_footnote_tags',
+        'suppress_illustration_tags', 'suppress_sidenote_tags']
+
     def __init__(self, args):
         super().__init__(args)
         self.from_pgdp_rounds = False
@@ -146,71 +412,35 @@ class pgdp_file_text(pgdp_file):
             self.has_oe_dp = True
 
 
+    def cleanup_flags(self):
+        """Return the flags selecting the cleanup rules for this file, in
+        TXT_CLEANUP_RULES."""
+        args = self.args
+        flags = {"rounds" if self.from_pgdp_rounds else "pp",
+                 "ignore_format" if args.ignore_format else "keep_format"}
+
+        if args.txt_cleanup_type == "b":
+            flags.add("best")
+        if args.suppress_proofers_notes:
+            flags.add("proofers_notes")
+        if args.regroup_split_words:
+            flags.add("regroup")
+        if args.ignore_format or args.suppress_footnote_tags:
+            flags.add("footnote_tags")
+        if args.ignore_format or args.suppress_illustration_tags:
+            flags.add("illustration_tags")
+        if args.ignore_format or args.suppress_sidenote_tags:
+            flags.add("sidenote_tags")
+
+        return frozenset(flags)
+
     def convert(self):
         """Remove markers from the text."""
 
         if self.args.txt_cleanup_type == "n":
             return
 
-        if self.from_pgdp_rounds:
-            # Clean proofers
-            self.text = re.sub(r"-----File: \w+.png.*", '', self.text)
-
-        if self.args.txt_cleanup_type == "p":
-            # Proofers only. Done.
-            return
-
-        # Clean all.
-        if self.from_pgdp_rounds:
-            self.text = self.text.replace("\n/*\n", '\n\n')
-            self.text = self.text.replace("\n*/\n", '\n\n')
-            self.text = self.text.replace("\n/#\n", '\n\n')
-            self.text = self.text.replace("\n#/\n", '\n\n')
-            self.text = self.text.replace("\n/P\n", '\n\n')
-            self.text = self.text.replace("\nP/\n", '\n\n')
-
-            if self.args.ignore_format:
-                self.text = self.text.replace("<i>", "")
-                self.text = self.text.replace("</i>", "")
-            else:
-                self.text = self.text.replace("<i>", "_")
-                self.text = self.text.replace("</i>", "_")
-
-            self.text = re.sub("<.*?>", '', self.text)
-            self.text = re.sub("</.*?>", '', self.text)
-            self.text = re.sub(r"\[Blank Page\]", '', self.text)
-
-            if self.args.suppress_proofers_notes:
-                self.text = re.sub(r"\[\*\*[^]]*?\]", '', self.text)
-
-            if self.args.regroup_split_words:
-                self.text = re.sub(r"(\w+)-\*(\n+)\*", r'\2\1', self.text)
-                self.text = re.sub(r"(\w+)-\*_(\n\n)_\*", r"\2\1", self.text)
-                self.text = re.sub(r"(\w+)-\*(\w+)", r"\1\2", self.text)
-
-        else:
-            if self.args.ignore_format:
-                self.text = self.text.replace("_", "")
-
-            # Horizontal separation
-            self.text = self.text.replace("*       *       *       *       *", "")
-            self.text = self.text.replace("*     *     *     *     *", "")
-
-
-        # Remove [Footnote, [Illustrations and [Sidenote tags
-        if self.args.ignore_format or self.args.suppress_footnote_tags:
-            self.text = re.sub(r"\[Footnote (\d+): ", r'\1 ', self.text)
-            self.text = re.sub(r"\*\[Footnote: ", '', self.text)
-
-        if self.args.ignore_format or self.args.suppress_illustration_tags:
-            self.text = re.sub(r"\[Illustrations?:([^]]*?)\]", r'\1', self.text, flags=re.MULTILINE)
-            self.text = re.sub(r"\[Illustration\]", '', self.text)
-
-        if self.args.ignore_format or self.args.suppress_sidenote_tags:
-            self.text = re.sub(r"\[Sidenote:([^]]*?)\]", r'\1', self.text, flags=re.MULTILINE)
-
-        # Replace -- with real mdash
-        self.text = self.text.replace("--", "—")
+        self.text = txt_cleanup(self.text, self.cleanup_flags())
 
 
     def extract_footnotes_pgdp(self):
@@ -282,16 +512,16 @@ class pgdp_file_text(pgdp_file):
 
     def transform(self):
         """Final cleanup."""
-        for func in self.transform_func:
-            self.text = func(self.text)
-
-        # Apply transform function to the footnotes
-        for func in self.transform_func:
-            self.footnotes = func(self.footnotes)
+        self.text = self.normalizer(self.text)
+        self.footnotes = self.normalizer(self.footnotes)
 
 
 class pgdp_file_html(pgdp_file):
 
+    options = pgdp_file.options + [
+        'css_no_default', 'css_smcap', 'css_bold', 'css_greek_title_plus',
+        'css_add_illustration', 'css_add_sidenote', 'css', 'css_backend']
+
     def __init__(self, args):
         super().__init__(args)
 
@@ -301,7 +531,7 @@ class pgdp_file_html(pgdp_file):
 
     def load(self, filename):
         """Load the file"""
-        self.myfile.load_xhtml(filename, relax=True)
+        self.myfile.load_xhtml_cached(filename, relax=True)
 
 
     def process_args(self, args):
@@ -396,200 +626,24 @@ class pgdp_file_html(pgdp_file):
         self.has_oe_ligature = True
 
 
-    def text_apply(self, element, func):
-        """Apply a function to every sub element's .text and .tail,
-        and element's .text."""
-        if element.text:
-            element.text = func(element.text)
-        for el in element.iter():
-            if el == element:
-                continue
-            if el.text:
-                el.text = func(el.text)
-            if el.tail:
-                el.tail = func(el.tail)
-
-
     def convert(self):
         """Remove HTML and PGDP marker from the text."""
 
-        escaped_unicode_re = re.compile(r"\\u[0-9a-fA-F]{4}")
-        def escaped_unicode(m):
-            try:
-                newstr = bytes(m.group(0), 'utf8').decode('unicode-escape')
-            except Exception:
-                newstr = m.group(0)
-
-            return newstr
-
-        def new_content(element):
-            """Process the "content:" property
-            """
-            retstr = ""
-            for token in val.value:
-                if token.type == "STRING":
-                    # e.g. { content: "xyz" }
-                    retstr += escaped_unicode_re.sub(escaped_unicode, token.value)
-                elif token.type == "FUNCTION":
-                    if token.function_name == 'attr':
-                        # e.g. { content: attr(title) }
-                        retstr += element.attrib.get(token.content[0].value, "")
-                elif token.type == "IDENT":
-                    if token.value == "content":
-                        # Identity, e.g. { content: content }
-                        retstr += element.text
-
-            return retstr
-
-
-        # Process each rule from our transformation CSS
-        stylesheet = tinycss.make_parser().parse_stylesheet(self.mycss)
-        property_errors = []
-        for rule in stylesheet.rules:
-
-            # Extract values we care about
-            f_transform = None
-            f_replace_with_attr = None
-            #f_replace_regex = None
-            f_text_replace = None
-            f_element_func = None
-            f_move = None
-
-            for val in rule.declarations:
-
-                if val.name == 'content':
-                    # result depends on element and pseudo elements.
-                    pass
-
-                elif val.name == "text-transform":
-                    if len(val.value) != 1:
-                        property_errors += [(val.line, val.column, val.name + " takes 1 argument")]
-                    else:
-                        v = val.value[0].value
-                        if v == "uppercase":
-                            f_transform = lambda x: x.upper()
-                        elif v == "lowercase":
-                            f_transform = lambda x: x.lower()
-                        elif v == "capitalize":
-                            f_transform = lambda x: x.title()
-                        else:
-                            property_errors += [(val.line, val.column, val.name + " accepts only 'uppercase', 'lowercase' or 'capitalize'")]
-
-                elif val.name == "_replace_with_attr":
-                    f_replace_with_attr = lambda el: el.attrib[val.value[0].value]
-
-                elif val.name == "text-replace":
-                    # Skip S (spaces) tokens.
-                    values = [v for v in val.value if v.type != "S"]
-                    if len(values) != 2:
-                        property_errors += [(val.line, val.column, val.name + " takes 2 string arguments")]
-                    else:
-                        v1 = values[0].value
-                        v2 = values[1].value
-                        f_text_replace = lambda x: x.replace(v1, v2)
-
-                elif val.name == "display":
-                    # Support display none only. So ignore "none" argument.
-                    f_element_func = clear_element
-
-                elif val.name == "_graft":
-                    values = [v for v in val.value if v.type != "S"]
-                    if len(values) < 1:
-                        property_errors += [(val.line, val.column, val.name + " takes at least one argument")]
-                        continue
-                    f_move = []
-                    for v in values:
-                        print("[", v.value, "]")
-                        if v.value == 'parent':
-                            f_move.append(lambda el: el.getparent())
-                        elif v.value == 'prev-sib':
-                            f_move.append(lambda el: el.getprevious())
-                        elif v.value == 'next-sib':
-                            f_move.append(lambda el: el.getnext())
-                        else:
-                            property_errors += [(val.line, val.column, val.name + " invalid value " + v.value)]
-                            f_move = None
-                            break
-
-                    if not f_move:
-                        continue
-
-#                elif val.name == "_replace_regex":
-#                    f_replace_regex = partial(re.sub, r"(\d)\u00A0(\d)", r"\1\2")
-#                    f_replace_regex = partial(re.sub, val.value[0].value, val.value[1].value)
-
-                else:
-                    property_errors += [(val.line, val.column, "Unsupported property " + val.name)]
-                    continue
-
-                # Iterate through each selectors in the rule
-                for selector in cssselect.parse(rule.selector.as_css()):
-
-                    pseudo_element = selector.pseudo_element
-
-                    xpath = cssselect.HTMLTranslator().selector_to_xpath(selector)
-                    find = etree.XPath(xpath)
-
-                    # Find each matching element in the HTML/XHTML document
-                    for element in find(self.myfile.tree):
-
-                        # Replace text with content of an attribute.
-                        if f_replace_with_attr:
-                            element.text = f_replace_with_attr(element)
-
-                        if val.name == 'content':
-                            v_content = new_content(element)
-                            if pseudo_element == "before":
-                                element.text = v_content + (element.text or '') # opening tag
-                            elif pseudo_element == "after":
-                                element.tail = v_content + (element.tail or '') # closing tag
-                            else:
-                                # Replace all content
-                                element.text = new_content(element)
-
-                        if f_transform:
-                            self.text_apply(element, f_transform)
-
-                        if f_text_replace:
-                            self.text_apply(element, f_text_replace)
-
-                        if f_element_func:
-                            f_element_func(element)
-
-                        if f_move:
-                            parent = element.getparent()
-                            new = element
-                            for f in f_move:
-                                new = f(new)
-
-                            # Move the tail to the sibling or the parent
-                            if element.tail:
-                                sibling = element.getprevious()
-                                if sibling:
-                                    sibling.tail = (sibling.tail or "") + element.tail
-                                else:
-                                    parent.text = (parent.text or "") + element.tail
-                                element.tail = None
-
-                            # Prune and graft
-                            parent.remove(element)
-                            new.append(element)
-
-                       # if f_replace_regex and element.text:
-                       #     element.text = f_replace_regex(element.text)
-
+        # Apply the transformation CSS. The tree is a new one with
+        # the xslt backend.
+        self.myfile.tree = apply_css(self.myfile.tree, self.mycss,
+                                     self.args.css_backend)
 
+        css = compile_transform_css(self.mycss)
         css_errors = ""
-        if stylesheet.errors or property_errors:
+        if css.errors or css.property_errors:
             # There is transformation CSS errors. If the default css
             # is included, take the offset into account.
             i = 0
             if self.args.css_no_default is False:
                 i = DEFAULT_TRANSFORM_CSS.count('\n')
             css_errors = "<div class='error-border bbox'><p>Error(s) in the transformation CSS:</p><ul>"
-            for err in stylesheet.errors:
-                css_errors += "<li>{0},{1}: {2}</li>".format(err.line-i, err.column, err.reason)
-            for err in property_errors:
+            for err in css.errors + css.property_errors:
                 css_errors += "<li>{0},{1}: {2}</li>".format(err[0]-i, err[1], err[2])
             css_errors += "</ul>"
 
@@ -662,34 +716,172 @@ class pgdp_file_html(pgdp_file):
             self.footnotes = "\n".join(footnotes)
 
 
-    def transform(self):
-        """Transform html into text. Do a final cleanup."""
+    def to_text(self):
+        """Transform html into text."""
         self.text = etree.XPath("string(/)")(self.myfile.tree)
 
 #        ff=open("compfilehtml.txt", "w")
 #        ff.write(self.text)
 #        ff.close()
 
-        # Apply transform function to the main text
-        for func in self.transform_func:
-            self.text = func(self.text)
 
-        # Apply transform function to the footnotes
-        for func in self.transform_func:
-            self.footnotes = func(self.footnotes)
+    def transform(self):
+        """Do a final cleanup."""
+
+        # Apply the character conversions to the main text and the
+        # footnotes
+        self.text = self.normalizer(self.text)
+        self.footnotes = self.normalizer(self.footnotes)
 
         # zero width space
         if self.args.ignore_0_space:
             self.text = self.text.replace(chr(0x200b), "")
 
 
+# dwdiff is stopped after that many seconds.
+DWDIFF_TIMEOUT = 60
+
+LINENO_RE = re.compile(r"\s*(\d+):(\d+)")
+
+# The markers of dwdiff, and the kind of text they start.
+MARKERS_RE = re.compile(r"(\]COMPPP_(?:START|STOP)_(?:DEL|INS)\[)")
+MARKERS = {
+    "]COMPPP_START_DEL[": "del",
+    "]COMPPP_STOP_DEL[": "eq",
+    "]COMPPP_START_INS[": "ins",
+    "]COMPPP_STOP_INS[": "eq",
+}
+
+
+# The line numbers of dwdiff -L, with their padding.
+LINENO_FIELDS_RE = re.compile(r"(\s*\d+):(\d+)( *)")
+
+
+def shift_line_numbers(lines, start):
+    """Shift the line numbers of the lines of a diff, in the format of
+    dwdiff -L, by start. The columns stay aligned while the numbers
+    fit in them."""
+    for line in lines:
+        m = LINENO_FIELDS_RE.match(line)
+        if m:
+            old = str(int(m.group(1)) + start)
+            old = old.rjust(len(m.group(1)))
+            new = str(int(m.group(2)) + start)
+            if m.group(3):
+                # The padding, then a space.
+                new = new.ljust(len(m.group(2)) + len(m.group(3)) - 1) + " "
+            line = old + ":" + new + line[m.end():]
+        yield line
+
+
+def diff_sections(lines):
+    """Group the lines of a diff, in the format of dwdiff -L, into
+    diff sections, as they come. Each section is a list of lines,
+    with their newline."""
+    section = []
+    for line in lines:
+        if line == "--\n":
+            yield section
+            section = []
+        else:
+            section.append(line)
+
+    if section:
+        yield section
+
+
+def parse_section(section, start0, start1):
+    """Turn a diff section into a hunk: a list of (line number in the
+    first text, line number in the second text, segments). The line
+    numbers are shifted by start0 and start1. The segments are the
+    rest of the line, as a list of (kind, text), where kind is 'eq',
+    'del' or 'ins'."""
+    hunk = []
+    kind = "eq"
+    for line in section:
+        line = line.rstrip("\n")
+        m = LINENO_RE.match(line)
+        if m:
+            old, new = int(m.group(1)) + start0, int(m.group(2)) + start1
+            line = line[m.end():]
+        else:
+            old = new = None
+
+        segments = []
+        for n, text in enumerate(MARKERS_RE.split(line)):
+            if n % 2:
+                kind = MARKERS[text]
+            elif text:
+                segments.append((kind, text))
+
+        hunk.append((old, new, segments))
+
+    return hunk
+
+
+def render_hunk(hunk):
+    """Turn a hunk into html."""
+    html = "<hr /><pre>\n"
+    for old, new, segments in hunk:
+        if old is not None:
+            html += "<span class='lineno'>{0} : {1}</span>".format(old, new)
+        for kind, text in segments:
+            text = text.replace("&", "&amp;")
+            text = text.replace("<", "&lt;")
+            text = text.replace(">", "&gt;")
+            if kind == "del":
+                text = "<del>" + text + "</del>"
+            elif kind == "ins":
+                text = "<ins>" + text + "</ins>"
+            html += text
+        html += "\n"
+
+    return html + "</pre>"
+
+
 class CompPP(object):
     """Compare two files.
     """
 
-    def __init__(self, args):
+    def __init__(self, args, cache=None):
         self.args = args
 
+        # DiskCache for the prepared files, if any.
+        self.cache = cache
+
+        # Time and memory used by each stage.
+        self.timings = Timings()
+
+    def load_file(self, fname):
+        """Create the object for a file, and prepare it. The result
+        comes from the cache if the same file was already prepared
+        with the same options."""
+
+        # Look for file type.
+        if fname.lower().endswith(('.html', '.htm')):
+            f = pgdp_file_html(self.args)
+        else:
+            f = pgdp_file_text(self.args)
+
+        with self.timings.stage("prepare", os.path.basename(fname)):
+            if self.cache is None:
+                f.prepare(fname, self.timings)
+                return f
+
+            key = self.cache.key(type(f).__name__,
+                                 os.path.basename(fname),
+                                 file_digest(fname),
+                                 options_digest(self.args, only=f.options))
+
+            state = self.cache.get(key)
+            if state is None:
+                f.prepare(fname, self.timings)
+                self.cache.put(key, f.get_state())
+            else:
+                f.set_state(state)
+
+            return f
+
     def oelig_convert(self, convert_oelig, text):
         # Do the required oelig conversion
         if convert_oelig == 1:
@@ -741,7 +933,58 @@ class CompPP(object):
         # We could have used the difflib module, but it's too slow:
         #    for line in difflib.unified_diff(f1.words, f2.words):
         #        print(line)
-        # Use diff instead.
+        # Use our own word diff, or dwdiff if asked. Both have the
+        # same output.
+        return "".join(self.diff_lines(text1, text2, debug))
+
+
+    def diff_lines(self, text1, text2, debug=False):
+        """Compare two texts. Return an iterator over the lines of the
+        diff, produced as the comparison goes. Identical texts are not
+        compared, and only the lines between those both texts start
+        and end with are given to the diff engine."""
+        if text1 == text2:
+            return iter([])
+
+        start, text1, text2 = worddiff.trim_common_lines(text1, text2)
+
+        if self.args.diff_backend == "dwdiff":
+            lines = self.dwdiff_lines(text1, text2, debug)
+            if start:
+                lines = shift_line_numbers(lines, start)
+            return lines
+
+        return self.word_diff_lines(text1, text2, start)
+
+
+    def word_diff_lines(self, text1, text2, start=0):
+        # Compare two sources with our own word diff. Nothing is done
+        # until the first line is asked for. The line numbers are
+        # shifted by start.
+        if self.args.chunked_diff:
+            # Large books. Cut into chunks diffed in parallel, whose
+            # hunks come as soon as the chunks before them are
+            # done. The line numbers are then as wide as the number of
+            # lines.
+            hunks = worddiff.iter_chunked_hunks(text1, text2,
+                                                ignore_case=self.args.ignore_case,
+                                                context=2)
+            hunks = (worddiff.shift_hunk(hunk, start, start) for hunk in hunks)
+            width = len(str(start + max(text1.count("\n"), text2.count("\n")) + 1))
+        else:
+            # The whole diff is done before the first hunk comes.
+            hunks = worddiff.diff_hunks(text1, text2,
+                                        ignore_case=self.args.ignore_case,
+                                        context=2)
+            hunks = worddiff.shift_hunks(hunks, start, start)
+            width = None
+
+        yield from worddiff.format_hunk_lines(hunks, width)
+
+
+    def dwdiff_lines(self, text1, text2, debug=False):
+        # Compare two sources with dwdiff. The process is started
+        # now, and its output read as it comes.
 
         # Some debug code
         if False and debug:
@@ -752,92 +995,153 @@ class CompPP(object):
             f.write(text2.encode('utf-8'))
             f.close()
 
-        with tempfile.NamedTemporaryFile(mode='wb') as t1, tempfile.NamedTemporaryFile(mode='wb') as t2:
-
-            t1.write(text1.encode('utf-8'))
-            t2.write(text2.encode('utf-8'))
-
-            t1.flush()
-            t2.flush()
-
-            repo_dir = os.environ.get("OPENSHIFT_DATA_DIR", "")
-            if repo_dir:
-                dwdiff_path = os.path.join(repo_dir, "bin", "dwdiff")
-            else:
-                dwdiff_path = "dwdiff"
-
-            cmd = [dwdiff_path,
-                   "-P",
-                   "-R",
-                   "-C 2",
-                   "-L",
-                   "-w ]COMPPP_START_DEL[",
-                   "-x ]COMPPP_STOP_DEL[",
-                   "-y ]COMPPP_START_INS[",
-                   "-z ]COMPPP_STOP_INS["]
-
-            if self.args.ignore_case:
-                cmd += ["--ignore-case"]
-
-            cmd += [t1.name, t2.name]
-
-            # That shouldn't be needed if openshift was utf8 by default.
-            env = os.environ.copy()
-            env["LANG"] = "en_US.UTF-8"
+        repo_dir = os.environ.get("OPENSHIFT_DATA_DIR", "")
+        if repo_dir:
+            dwdiff_path = os.path.join(repo_dir, "bin", "dwdiff")
+        else:
+            dwdiff_path = "dwdiff"
+
+        cmd = [dwdiff_path,
+               "-P",
+               "-R",
+               "-C 2",
+               "-L",
+               "-w ]COMPPP_START_DEL[",
+               "-x ]COMPPP_STOP_DEL[",
+               "-y ]COMPPP_START_INS[",
+               "-z ]COMPPP_STOP_INS["]
+
+        if self.args.ignore_case:
+            cmd += ["--ignore-case"]
+
+        # The texts are given through pipes instead of files. dwdiff
+        # reads them from /dev/fd/N.
+        pipes = [os.pipe(), os.pipe()]
+        cmd += ["/dev/fd/{0}".format(r) for r, w in pipes]
+
+        # That shouldn't be needed if openshift was utf8 by default.
+        env = os.environ.copy()
+        env["LANG"] = "en_US.UTF-8"
 
+        try:
             p = subprocess.Popen(cmd,
                                  stdout=subprocess.PIPE,
+                                 stderr=subprocess.PIPE,
+                                 pass_fds=[r for r, w in pipes],
+                                 start_new_session=True,
                                  env=env)
-
-            # The output is raw, so we have to decode it to UTF-8, which
-            # is the default under Ubuntu.
-            return p.stdout.read().decode('utf-8')
-
-
-    def create_html(self, files, text, footnotes):
-
-        def massage_input(text, start0, start1):
-            # Massage the input
-            text = text.replace("&", "&amp;")
-            text = text.replace("<", "&lt;")
-            text = text.replace(">", "&gt;")
-
-            text = text.replace("]COMPPP_START_DEL[", "<del>")
-            text = text.replace("]COMPPP_STOP_DEL[", "</del>")
-            text = text.replace("]COMPPP_START_INS[", "<ins>")
-            text = text.replace("]COMPPP_STOP_INS[", "</ins>")
-
-            if text:
-                text = "<hr /><pre>\n" + text
-            text = text.replace("\n--\n", "\n</pre><hr /><pre>\n")
-
-            text = re.sub(r"^\s*(\d+):(\d+)",
-                          lambda m: "<span class='lineno'>{0} : {1}</span>".format(int(m.group(1)) + start0,
-                                                                                   int(m.group(2)) + start1),
-                          text, flags=re.MULTILINE)
-            if text:
-                text = text + "</pre>\n"
-
-
-            return text
-
-        # Find the number of diff sections
-        nb_diffs_text = 0
-        if text:
-            nb_diffs_text = len(re.findall("\n--\n", text)) + 1
-
-        nb_diffs_footnotes = 0
-        if footnotes:
-            nb_diffs_footnotes = len(re.findall("\n--\n", footnotes or "")) + 1
-
-        # Text, with correct (?) line numbers
-        text = massage_input(text, files[0].start_line, files[1].start_line)
-
-        # Footnotes - line numbers are meaningless right now. We could fix
-        # that.
-        footnotes = massage_input(footnotes, 0, 0)
-
-        html_content = "<div>"
+        except Exception:
+            for r, w in pipes:
+                os.close(w)
+            raise
+        finally:
+            for r, w in pipes:
+                os.close(r)
+
+        def feed(fd, text):
+            try:
+                with open(fd, "wb") as f:
+                    f.write(text.encode('utf-8'))
+            except BrokenPipeError:
+                # dwdiff stopped before reading everything.
+                pass
+
+        # Feed both texts, and collect the errors, while dwdiff runs.
+        errors = []
+        threads = [threading.Thread(target=feed, args=(w, text))
+                   for (r, w), text in zip(pipes, (text1, text2))]
+        threads.append(threading.Thread(target=lambda: errors.append(p.stderr.read())))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+
+        # Don't let a hung or huge comparison hold the worker. dwdiff
+        # runs diff, which must be stopped too.
+        timed_out = []
+        def kill():
+            try:
+                os.killpg(p.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+        def stop():
+            timed_out.append(True)
+            kill()
+
+        timer = None
+        if self.args.dwdiff_timeout:
+            timer = threading.Timer(self.args.dwdiff_timeout, stop)
+            timer.daemon = True
+            timer.start()
+
+        # The output is read as fast as dwdiff writes it, whatever
+        # the reader of the lines does, so the timeout only counts
+        # dwdiff's own work. It stops once dwdiff has exited.
+        output = queue.Queue()
+        def read():
+            try:
+                # The output is raw, so we have to decode it to UTF-8,
+                # which is the default under Ubuntu.
+                for line in io.TextIOWrapper(p.stdout, encoding='utf-8', newline='\n'):
+                    output.put(line)
+            finally:
+                p.stdout.close()
+                p.wait()
+                if timer:
+                    timer.cancel()
+                output.put(None)
+
+        reader = threading.Thread(target=read)
+        reader.daemon = True
+        reader.start()
+
+        def lines():
+            try:
+                yield from iter(output.get, None)
+            finally:
+                # Stop dwdiff if the lines are not all wanted.
+                if reader.is_alive():
+                    kill()
+                reader.join()
+                for thread in threads:
+                    thread.join()
+                p.stderr.close()
+
+            if timed_out:
+                raise RuntimeError("dwdiff was stopped after {0} seconds".format(self.args.dwdiff_timeout))
+
+            # dwdiff exits with 1 when the texts are different, and 2
+            # on error.
+            if p.returncode not in (0, 1):
+                message = b"".join(errors).decode('utf-8', 'replace').strip()
+                raise RuntimeError("dwdiff failed ({0}): {1}".format(p.returncode, message))
+
+        return lines()
+
+
+    def compare_streams(self, streams):
+        """Compare several pairs of texts (main text, footnotes, ...).
+        Returns the list of diffs, in the same order. With dwdiff, they
+        are compared at the same time, so that the waits on the child
+        processes overlap. The internal engine holds the GIL, so threads
+        would only add their overhead."""
+        def compare(n, text1, text2):
+            with self.timings.stage("diff", "text" if n == 0 else "footnotes"):
+                return self.compare_texts(text1, text2)
+
+        if len(streams) == 1 or self.args.diff_backend != "dwdiff":
+            return [compare(n, text1, text2)
+                    for n, (text1, text2) in enumerate(streams)]
+
+        with ThreadPoolExecutor(max_workers=len(streams)) as executor:
+            futures = [executor.submit(compare, n, text1, text2)
+                       for n, (text1, text2) in enumerate(streams)]
+            return [future.result() for future in futures]
+
+
+    def diff_summary(self, nb_diffs_text, nb_diffs_footnotes):
+        """The number of diff sections, as html."""
+        html_content = ""
 
         if nb_diffs_text == 0:
             html_content += "<p>There is no diff section in the main text.</p>"
@@ -846,11 +1150,9 @@ class CompPP(object):
         else:
             html_content += "<p>There are " + str(nb_diffs_text) + " diff sections in the main text.</p>"
 
-        if footnotes:
+        if nb_diffs_footnotes:
             html_content += "<p>Footnotes are diff'ed separately <a href='#footnotes'>here</a></p>"
-            if nb_diffs_footnotes == 0:
-                html_content += "<p>There is no diff section in the footnotes.</p>"
-            elif nb_diffs_footnotes == 1:
+            if nb_diffs_footnotes == 1:
                 html_content += "<p>There is " + str(nb_diffs_footnotes) + " diff section in the footnotes.</p>"
             else:
                 html_content += "<p>There are " + str(nb_diffs_footnotes) + " diff sections in the footnotes.</p>"
@@ -858,14 +1160,32 @@ class CompPP(object):
             if self.args.extract_footnotes:
                 html_content += "<p>There is no diff section in the footnotes.</p>"
 
-        if nb_diffs_text:
+        return html_content
+
+
+    def create_html(self, files, text, footnotes):
+
+        # Text, with correct (?) line numbers
+        text = [render_hunk(parse_section(section, files[0].start_line, files[1].start_line))
+                for section in diff_sections(io.StringIO(text, newline="\n"))]
+
+        # Footnotes - line numbers are meaningless right now. We could fix
+        # that.
+        footnotes = [render_hunk(parse_section(section, 0, 0))
+                     for section in diff_sections(io.StringIO(footnotes or "", newline="\n"))]
+
+        html_content = "<div>"
+
+        html_content += self.diff_summary(len(text), len(footnotes))
+
+        if text:
             html_content += "<h2 class='sep4'>Main text</h2>"
-            html_content += text
+            html_content += "".join(text) + "\n"
 
         if footnotes:
             html_content += "<h2 id='footnotes' class='sep4'>Footnotes</h2>"
             html_content += "<pre class='sep4'>"
-            html_content += footnotes
+            html_content += "".join(footnotes) + "\n"
             html_content += "</pre>"
 
         html_content += "</div>"
@@ -882,22 +1202,18 @@ class CompPP(object):
         get a smaller diff.
         """
 
-        in_0 = files[0].char_text.find(char_best)
-        in_1 = files[1].char_text.find(char_best)
+        in_0 = char_best in files[0].chars
+        in_1 = char_best in files[1].chars
 
-        if in_0 >= 0 and in_1 >= 0:
-            # Both have it
-            return
-
-        if in_0 == -1 and in_1 == -1:
-            # None have it
+        if in_0 == in_1:
+            # Both or none have it
             return
 
         # Downgrade one version
-        if in_0 > 0:
-            files[0].transform_func.append(lambda text: text.replace(char_best, char_other))
+        if in_0:
+            files[0].normalizer.replace(char_best, char_other)
         else:
-            files[1].transform_func.append(lambda text: text.replace(char_best, char_other))
+            files[1].normalizer.replace(char_best, char_other)
 
 
     def check_oelig(self, files):
@@ -907,46 +1223,35 @@ class CompPP(object):
         elif files[0].has_oe_dp and files[1].has_oe_dp:
             pass
         elif files[0].has_oe_ligature and files[1].has_oe_dp:
-            files[1].transform_func.append(lambda text: text.replace("[oe]", "œ"))
-            files[1].transform_func.append(lambda text: text.replace("[OE]", "Œ"))
+            files[1].normalizer.replace("[oe]", "œ")
+            files[1].normalizer.replace("[OE]", "Œ")
         elif files[1].has_oe_ligature and files[0].has_oe_dp:
-            files[0].transform_func.append(lambda text: text.replace("[oe]", "œ"))
-            files[0].transform_func.append(lambda text: text.replace("[OE]", "Œ"))
+            files[0].normalizer.replace("[oe]", "œ")
+            files[0].normalizer.replace("[OE]", "Œ")
         else:
             if files[0].has_oe_ligature:
-                files[0].transform_func.append(lambda text: text.replace("œ", "oe"))
-                files[0].transform_func.append(lambda text: text.replace("Œ", "OE"))
+                files[0].normalizer.replace("œ", "oe")
+                files[0].normalizer.replace("Œ", "OE")
             elif files[1].has_oe_ligature:
-                files[1].transform_func.append(lambda text: text.replace("œ", "oe"))
-                files[1].transform_func.append(lambda text: text.replace("Œ", "OE"))
+                files[1].normalizer.replace("œ", "oe")
+                files[1].normalizer.replace("Œ", "OE")
 
             if files[0].has_oe_dp:
-                files[0].transform_func.append(lambda text: text.replace("[oe]", "oe"))
-                files[0].transform_func.append(lambda text: text.replace("[OE]", "OE"))
+                files[0].normalizer.replace("[oe]", "oe")
+                files[0].normalizer.replace("[OE]", "OE")
             elif files[1].has_oe_dp:
-                files[1].transform_func.append(lambda text: text.replace("[oe]", "oe"))
-                files[1].transform_func.append(lambda text: text.replace("[OE]", "OE"))
+                files[1].normalizer.replace("[oe]", "oe")
+                files[1].normalizer.replace("[OE]", "OE")
 
 
-    def do_process(self):
-
-        files = [None, None]
-
-        # Load files
-        for i, fname in enumerate(self.args.filename):
-
-            # Look for file type.
-            if fname.lower().endswith(('.html', '.htm')):
-                files[i] = pgdp_file_html(self.args)
-            else:
-                files[i] = pgdp_file_text(self.args)
-
-            f = files[i]
-
-            f.load(fname)
-            f.process_args(self.args)
-            f.analyze()
+    def prepare_files(self):
+        """Load and prepare the files, and make them ready to be
+        compared. Returns the files and the conversion errors."""
 
+        # Load and prepare the files. They are independent until the
+        # checks below, and lxml releases the GIL while parsing.
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            files = list(executor.map(self.load_file, self.args.filename))
 
         # How to process oe ligature
         self.check_oelig(files)
@@ -985,51 +1290,82 @@ class CompPP(object):
         # Remove non-breakable spaces between numbers. For instance, a
         # text file could have 250000, and the html could have 250 000.
         if self.args.suppress_nbsp_num:
-            func = lambda text: re.sub(r"(\d)\u00A0(\d)", r"\1\2", text)
-            files[0].transform_func.append(func)
-            files[1].transform_func.append(func)
+            for f in files:
+                f.normalizer.sub(r"\d\u00A0\d", lambda s: s[0] + s[2])
 
         # Suppress shy (soft hyphen)
-        func = lambda text: re.sub(r"\u00AD", r"", text)
-        files[0].transform_func.append(func)
-        files[1].transform_func.append(func)
+        for f in files:
+            f.normalizer.sub(r"\u00AD", lambda s: "")
 
         # If the original encoding of them is latin1, we must convert a
         # few UTF8 characters. We assume the default is utf-8. No
         # provision for any other format.
-        if files[0].myfile.encoding == "iso-8859-1" or files[1].myfile.encoding == "iso-8859-1":
+        if any(sourcefile.is_single_byte(f.myfile.encoding) for f in files):
             for f in files:
-                if f.myfile.encoding != "iso-8859-1":
+                if not sourcefile.is_single_byte(f.myfile.encoding):
                     f.convert_to_latin1 = True
 
-        err_message = ""
+        # Errors from the various convertions
+        err_message = "".join(f.convert_errors for f in files)
 
-        # Apply the various convertions
+        # Transform the final document into a diffable format
         for f in files:
-            err_message += f.convert() or ""
+            with self.timings.stage("transform", f.myfile.basename):
+                f.transform()
+
+        return files, err_message
+
 
-        # Extract footnotes
+    def diff_streams(self, files):
+        """The pairs of texts to compare: the two versions, and the
+        footnotes if extracted."""
+        streams = [(files[0].text, files[1].text)]
         if self.args.extract_footnotes:
-            for f in files:
-                f.extract_footnotes()
+            streams.append((files[0].footnotes, files[1].footnotes))
+        return streams
 
-        # Transform the final document into a diffable format
-        for f in files:
-            f.transform()
 
-        # Compare the two versions
-        main_diff = self.compare_texts(files[0].text, files[1].text)
+    def do_process(self):
 
-        if self.args.extract_footnotes:
-            fnotes_diff = self.compare_texts(files[0].footnotes, files[1].footnotes)
-        else:
-            fnotes_diff = ""
+        files, err_message = self.prepare_files()
 
-        html_content = self.create_html(files, main_diff, fnotes_diff)
+        # Compare the two versions, and the footnotes if extracted
+        diffs = self.compare_streams(self.diff_streams(files))
+        main_diff = diffs[0]
+        fnotes_diff = diffs[1] if self.args.extract_footnotes else ""
+
+        with self.timings.stage("create_html"):
+            html_content = self.create_html(files, main_diff, fnotes_diff)
 
         return err_message, html_content, files[0].myfile.basename, files[1].myfile.basename
 
 
+    def stream_hunks(self):
+        """Same as do_process(), but as an iterator over the hunks of
+        the diff, produced while the texts are compared. Nothing is
+        done until the first item is requested, so the caller can send
+        something before. The first item is ("errors", err_message),
+        once the files are prepared, and the others are ("text" or
+        "footnotes", hunk)."""
+
+        files, err_message = self.prepare_files()
+        yield "errors", err_message
+
+        # Start all the comparisons now. dwdiff processes run at the
+        # same time.
+        diffs = [self.timings.iterate("diff", self.diff_lines(text1, text2),
+                                      "text" if n == 0 else "footnotes")
+                 for n, (text1, text2) in enumerate(self.diff_streams(files))]
+
+        for section in diff_sections(diffs[0]):
+            yield "text", parse_section(section, files[0].start_line, files[1].start_line)
+
+        # Footnotes - line numbers are meaningless right now.
+        for diff in diffs[1:]:
+            for section in diff_sections(diff):
+                yield "footnotes", parse_section(section, 0, 0)
+
+
     def simple_html(self):
         """For debugging purposes. Transform the html and print the
         text output."""
@@ -1041,33 +1377,19 @@ class CompPP(object):
         else:
             print("Error: not an html file")
 
-        f.load(fname)
-        if f.myfile is None:
-            print("Couldn't load file:", fname)
-            return
-
-        f.process_args(self.args)
-        f.analyze()
+        f.prepare(fname, self.timings)
 
         # Remove non-breakable spaces between numbers. For instance, a
         # text file could have 250000, and the html could have 250 000.
         if self.args.suppress_nbsp_num:
-            func = lambda text: re.sub(r"(\d)\u00A0(\d)", r"\1\2", text)
-            f.transform_func.append(func)
+            f.normalizer.sub(r"\d\u00A0\d", lambda s: s[0] + s[2])
 
         # Suppress shy (soft hyphen)
-        func = lambda text: re.sub(r"\u00AD", r"", text)
-        f.transform_func.append(func)
-
-        # Apply the various convertions
-        f.convert()
-
-        # Extract footnotes
-        if self.args.extract_footnotes:
-            f.extract_footnotes()
+        f.normalizer.sub(r"\u00AD", lambda s: "")
 
         # Transform the final document into a diffable format
-        f.transform()
+        with self.timings.stage("transform", f.myfile.basename):
+            f.transform()
 
         print(f.text)
 
@@ -1172,8 +1494,9 @@ def output_html(args, html_content, filename1, filename2):
 </html>
 """)
 
-def main():
-
+def build_parser():
+    """The command line options. They are also the options of
+    CompPP."""
     parser = argparse.ArgumentParser(description='Diff text document for PGDP PP.')
 
     parser.add_argument('filename', metavar='FILENAME', type=str,
@@ -1218,10 +1541,35 @@ def main():
                         help="TXT: Type of text cleaning -- (b)est effort, (n)one, (p)roofers")
     parser.add_argument('--simple-html', action='store_true', default=False,
                         help="HTML: Process the html file and print the output (debug)")
+    parser.add_argument('--downgrade-smart-quotes', action='store_true', default=False,
+                        help="Downgrade smart quotes if needed")
+    parser.add_argument('--cache-dir', type=str, default=None,
+                        help="Keep the prepared files in this directory, to reuse them")
+    parser.add_argument('--chunked-diff', action='store_true', default=False,
+                        help="Cut large books into aligned chunks, diffed in parallel (internal engine only)")
+    parser.add_argument('--diff-backend', type=str, default='internal',
+                        choices=['internal', 'dwdiff'],
+                        help="Diff engine to use -- (internal) word diff, or external (dwdiff)")
+    parser.add_argument('--dwdiff-timeout', type=int, default=DWDIFF_TIMEOUT,
+                        help="Stop dwdiff after that many seconds, or never if 0 (default: {0})".format(DWDIFF_TIMEOUT))
+    parser.add_argument('--timings', action='store_true', default=False,
+                        help="Print the time and memory used by each stage on stderr")
+    parser.add_argument('--css-backend', type=str, default='python',
+                        choices=['python', 'xslt'],
+                        help="Engine applying the transformation CSS -- (python), or (xslt) for the content and display rules, up to the first other one, which python applies with the rest")
+
+    return parser
+
 
-    args = parser.parse_args()
+def main():
+
+    args = build_parser().parse_args()
 
-    x = CompPP(args)
+    cache = None
+    if args.cache_dir:
+        cache = DiskCache(args.cache_dir)
+
+    x = CompPP(args, cache)
     if args.simple_html:
         x.simple_html()
     else:
@@ -1229,5 +1577,94 @@ def main():
 
         output_html(args, html_content, fn1, fn2)
 
+    if args.timings:
+        print(x.timings.text(), file=sys.stderr)
+
+
+def test_txt_cleanup():
+    # The PP text, and the same text with the markup of the rounds.
+    with open("data/testfiles/pg34332.txt", "rb") as f:
+        text = f.read().decode("latin-1")
+    rounds = ("-----File: 001.png---\\proofer\\\n/*\n<i>Un</i> <b>mot</b> [**note] cou-*\n*pé, "
+              "par-*_\n\n_*tie, en-*tier [Blank Page]\n*/\n/#\n[Footnote 1: une note]\n"
+              "*[Footnote: suite] [Illustration: image] [Illustration] [Sidenote: côté]\n#/\n"
+              "/P\n_vers_ -- *       *       *       *       *\nP/\n")
+
+    def sequential_txt_cleanup(text, args, from_pgdp_rounds):
+        # The cleanup of convert() before TXT_CLEANUP_RULES, one
+        # substitution at a time.
+        if args.txt_cleanup_type == "n":
+            return text
+
+        if from_pgdp_rounds:
+            text = re.sub(r"-----File: \w+.png.*", '', text)
+
+        if args.txt_cleanup_type == "p":
+            return text
+
+        if from_pgdp_rounds:
+            for markup in ("\n/*\n", "\n*/\n", "\n/#\n", "\n#/\n", "\n/P\n", "\nP/\n"):
+                text = text.replace(markup, '\n\n')
+
+            if args.ignore_format:
+                text = text.replace("<i>", "")
+                text = text.replace("</i>", "")
+            else:
+                text = text.replace("<i>", "_")
+                text = text.replace("</i>", "_")
+
+            text = re.sub("<.*?>", '', text)
+            text = re.sub("</.*?>", '', text)
+            text = re.sub(r"\[Blank Page\]", '', text)
+
+            if args.suppress_proofers_notes:
+                text = re.sub(r"\[\*\*[^]]*?\]", '', text)
+
+            if args.regroup_split_words:
+                text = re.sub(r"(\w+)-\*(\n+)\*", r'\2\1', text)
+                text = re.sub(r"(\w+)-\*_(\n\n)_\*", r"\2\1", text)
+                text = re.sub(r"(\w+)-\*(\w+)", r"\1\2", text)
+
+        else:
+            if args.ignore_format:
+                text = text.replace("_", "")
+
+            text = text.replace("*       *       *       *       *", "")
+            text = text.replace("*     *     *     *     *", "")
+
+        if args.ignore_format or args.suppress_footnote_tags:
+            text = re.sub(r"\[Footnote (\d+): ", r'\1 ', text)
+            text = re.sub(r"\*\[Footnote: ", '', text)
+
+        if args.ignore_format or args.suppress_illustration_tags:
+            text = re.sub(r"\[Illustrations?:([^]]*?)\]", r'\1', text, flags=re.MULTILINE)
+            text = re.sub(r"\[Illustration\]", '', text)
+
+        if args.ignore_format or args.suppress_sidenote_tags:
+            text = re.sub(r"\[Sidenote:([^]]*?)\]", r'\1', text, flags=re.MULTILINE)
+
+        return text.replace("--", "—")
+
+    args = build_parser().parse_args(["a.txt", "b.txt"])
+    for cleanup_type in ("n", "p", "b"):
+        for proofers_notes in (False, True):
+            for ignore_format in (False, True):
+                for from_pgdp_rounds in (False, True):
+                    args.txt_cleanup_type = cleanup_type
+                    args.suppress_proofers_notes = proofers_notes
+                    args.ignore_format = ignore_format
+                    args.regroup_split_words = proofers_notes
+                    args.suppress_footnote_tags = args.suppress_illustration_tags = \
+                        args.suppress_sidenote_tags = not proofers_notes
+
+                    f = pgdp_file_text(args)
+                    f.from_pgdp_rounds = from_pgdp_rounds
+                    for sample in (text, rounds + text):
+                        f.text = sample
+                        f.convert()
+                        assert f.text == sequential_txt_cleanup(sample, args, from_pgdp_rounds), \
+                            (cleanup_type, proofers_notes, ignore_format, from_pgdp_rounds)
+
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Download the XHTML DTDs, and the entity sets and modules they
+include, into the mirror of data/dtd. XHTML files are then validated
+without the network, and without the XML catalog of the system.
+"""
+
+import os
+import re
+import sys
+import argparse
+import urllib.request
+from urllib.parse import urljoin, urlsplit
+
+from helpers.sourcefile import DTD_DIR, XHTML_DTDS
+
+# The system identifiers of the files included by a DTD.
+INCLUDE_RE = re.compile(r"""["']([^"'\s]+\.(?:dtd|ent|mod))["']""")
+
+
+def fetch(urls, directory):
+    """Download the files, and the ones they include, that are not
+    already in the mirror."""
+    todo = list(urls)
+    seen = set()
+
+    while todo:
+        url = todo.pop()
+        if url in seen:
+            continue
+        seen.add(url)
+
+        parts = urlsplit(url)
+        filename = os.path.join(directory, parts.netloc, parts.path.lstrip("/"))
+        if os.path.isfile(filename):
+            with open(filename, "rb") as f:
+                content = f.read()
+        else:
+            print("Fetching", url, file=sys.stderr)
+            with urllib.request.urlopen(url) as response:
+                content = response.read()
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            with open(filename, "wb") as f:
+                f.write(content)
+
+        for include in INCLUDE_RE.findall(content.decode("latin-1")):
+            todo.append(urljoin(url, include))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Download the XHTML DTDs.')
+    parser.add_argument('--directory', type=str, default=DTD_DIR,
+                        help="Where to put the mirror (default: data/dtd)")
+    args = parser.parse_args()
+
+    fetch(XHTML_DTDS, args.directory)
+
+
+if __name__ == '__main__':
+    main()
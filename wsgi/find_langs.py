@@ -29,6 +29,23 @@ import os
 
 import helpers.sourcefile
 
+def element_text(element):
+    """Text of the element, with a space for each <br/>, since the
+    tree is shared and can't be changed."""
+    parts = [element.text or '']
+    for child in element:
+        if child.tag == 'br':
+            parts.append(' ')
+        if isinstance(child.tag, str):
+            parts.append(element_text(child))
+        parts.append(child.tail or '')
+    return ''.join(parts)
+
+def normalize_space(element):
+    """Same as the XPath normalize-space() of the element, with <br/>
+    as a space."""
+    return ' '.join(re.split(r'[ \t\r\n]+', element_text(element).strip(' \t\r\n')))
+
 class Languages(object):
 
     def init(self):
@@ -36,7 +53,7 @@ class Languages(object):
 
     def load_file(self, args):
         self.myfile = helpers.sourcefile.SourceFile()
-        self.myfile.load_xhtml(args.filename, relax=True)
+        self.myfile.load_xhtml_cached(args.filename, relax=True, readonly=True)
 
     def find_tags(self, args):
 
@@ -51,11 +68,6 @@ class Languages(object):
         else:
             lang_attr = "lang"
 
-        # Transform </br> to space because normalize-space doesn't do it
-        find = etree.XPath("//br")
-        for element in find(self.myfile.tree):
-            element.tail = ' ' + (element.tail or '')
-
         for element in self.myfile.tree.iter(tag=etree.Element):
 
             tag = element.tag
@@ -77,7 +89,7 @@ class Languages(object):
                 if tag == 'span' and lang == doc_lang:
                     continue
 
-                self.extracts.add((tag, lang, etree.XPath("normalize-space()")(element)))
+                self.extracts.add((tag, lang, normalize_space(element)))
 
 
 
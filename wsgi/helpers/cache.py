@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+
+# Disk cache. Part of pptools
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+"""
+Disk cache. Part of pptools.
+
+Results are stored in a directory, one file per entry, under the hash
+of everything they depend on. Entries are written to a temporary file
+then renamed, so several processes can share the same directory. The
+least recently used entries are removed when the directory grows too
+big.
+"""
+
+import os
+import json
+import pickle
+import hashlib
+import tempfile
+
+# Change this when the format of the cached results changes, to
+# ignore the old entries.
+CACHE_VERSION = "1"
+
+# Maximum size of a cache directory, in bytes.
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+CACHE_EXT = ".pickle"
+
+
+def file_digest(fname):
+    """Return the SHA-256 of a file content, in hex."""
+    h = hashlib.sha256()
+    with open(fname, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def options_digest(args, exclude=("filename",), only=None):
+    """Return the SHA-256 of a set of options. args is an argparse
+    namespace or any object with attributes. If only is given, only
+    these options are used.
+    """
+    options = {k: v for k, v in vars(args).items()
+               if k not in exclude and (only is None or k in only)}
+    canonical = json.dumps(options, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class DiskCache(object):
+    """A least recently used cache in a directory."""
+
+    def __init__(self, directory, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+
+    def key(self, *parts):
+        """Build a key from a list of strings, usually digests."""
+        h = hashlib.sha256(CACHE_VERSION.encode('utf-8'))
+        for part in parts:
+            h.update(b"\0" + part.encode('utf-8'))
+        return h.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + CACHE_EXT)
+
+    def get(self, key):
+        """Return the value stored for that key, or None."""
+        path = self.path(key)
+        try:
+            with open(path, "rb") as f:
+                value = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+
+        # Mark it as recently used.
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+        return value
+
+    def put(self, key, value):
+        """Store a value. Failures are ignored, since it's only a
+        cache."""
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+                os.replace(tmpname, self.path(key))
+            except Exception:
+                os.unlink(tmpname)
+                raise
+        except Exception:
+            return
+
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits
+        in max_size."""
+        entries = []
+        total = 0
+        try:
+            for entry in os.scandir(self.directory):
+                if not entry.name.endswith(CACHE_EXT):
+                    continue
+                try:
+                    st = entry.stat()
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        except OSError:
+            return
+
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                # Another process removed it already.
+                pass
+            total -= size
+
+
+def test_disk_cache():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = DiskCache(os.path.join(tmpdir, "cache"))
+        key = cache.key("a", "b")
+
+        assert key != cache.key("b", "a")
+        assert cache.get(key) is None
+
+        cache.put(key, ("", "<div></div>"))
+        assert cache.get(key) == ("", "<div></div>")
+
+
+def test_disk_cache_evict():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        cache = DiskCache(tmpdir, max_size=2500)
+
+        for i in range(3):
+            cache.put(cache.key(str(i)), "x" * 1000)
+            os.utime(cache.path(cache.key(str(i))), (i, i))
+
+        # The oldest entry is gone.
+        cache.evict()
+        assert cache.get(cache.key("0")) is None
+        assert cache.get(cache.key("2")) == "x" * 1000
+
+
+def test_options_digest():
+    args = lambda: 0
+    args.filename = ["a", "b"]
+    args.css = "p { display: none }"
+    args.ignore_case = False
+    digest = options_digest(args)
+
+    # File names are not part of the options.
+    args.filename = ["c", "d"]
+    assert options_digest(args) == digest
+
+    args.ignore_case = True
+    assert options_digest(args) != digest
+    assert options_digest(args, only=["css"]) != digest
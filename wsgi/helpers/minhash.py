@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+
+# Similarity of texts. Part of pptools
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+"""
+Similarity of texts. Part of pptools.
+
+A text is cut into shingles, the sequences of SHINGLE_SIZE
+consecutive words, ignoring case and punctuation. Its signature is
+the SIGNATURE_SIZE smallest hashes of its shingles (a bottom-k
+MinHash). The Jaccard similarity of the shingles of two texts, i.e.
+the proportion of shingles they share, is estimated from their
+signatures alone.
+
+Signatures are small, so they can be computed once per file and
+kept, and all the pairs of files of a project are compared in a few
+milliseconds.
+"""
+
+import re
+import heapq
+import hashlib
+
+WORD_RE = re.compile(r"[^\W_]+")
+
+SHINGLE_SIZE = 5
+SIGNATURE_SIZE = 256
+
+
+def shingle_hash(shingle):
+    """A 64 bits hash of a shingle, the same in all processes."""
+    return int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+def signature(text, shingle_size=SHINGLE_SIZE, size=SIGNATURE_SIZE):
+    """Return the signature of a text, as a sorted list of hashes."""
+    words = WORD_RE.findall(text.lower())
+    if len(words) < shingle_size:
+        shingles = [" ".join(words)] if words else []
+    else:
+        shingles = set(" ".join(words[i:i + shingle_size])
+                       for i in range(len(words) - shingle_size + 1))
+
+    return heapq.nsmallest(size, set(shingle_hash(s) for s in shingles))
+
+
+def similarity(signature1, signature2, size=SIGNATURE_SIZE):
+    """Estimate the Jaccard similarity, between 0 and 1, of the texts
+    of two signatures."""
+    if not signature1 and not signature2:
+        return 1.0
+
+    # The smallest hashes of the union of both texts, and how many are
+    # in both.
+    union = heapq.nsmallest(size, set(signature1) | set(signature2))
+    both = set(signature1) & set(signature2)
+    return sum(1 for h in union if h in both) / len(union)
+
+
+def test_similarity():
+    words = ["word{0}".format(i) for i in range(2000)]
+    text = " ".join(words)
+    sig = signature(text)
+    assert len(sig) == SIGNATURE_SIZE and sig == sorted(sig)
+
+    # Case and punctuation don't matter.
+    assert similarity(sig, signature(text.upper().replace(" ", ", "))) == 1.0
+
+    # Half the text replaced: a third of the shingles in common.
+    other = " ".join(words[:1000] + ["other{0}".format(i) for i in range(1000)])
+    assert 0.2 < similarity(sig, signature(other)) < 0.5
+
+    assert similarity(sig, signature("something else entirely, and more")) == 0.0
+    assert similarity(signature(""), signature("")) == 1.0
+    assert similarity(signature("a b"), signature("a b")) == 1.0
@@ -0,0 +1,318 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+
+# Index of a document for simple CSS selectors. Part of comp_pp
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+"""
+Index of a document for simple CSS selectors. Part of comp_pp.
+
+Most selectors of a transformation CSS are only made of a tag name,
+classes, an id and attribute tests, such as span[class^="pagenum"].
+Instead of scanning the whole tree with XPath for each of them, the
+elements are indexed by tag, class, id and attribute name in a single
+pass, and these selectors are answered from the index. They return
+the same elements, in the same order, as the XPath given by
+cssselect's HTMLTranslator.
+"""
+
+import re
+import bisect
+from lxml import etree
+import cssselect
+
+# Whitespace for the XPath normalize-space() function.
+XPATH_SPACE_RE = re.compile(r"[ \t\r\n]+")
+
+# Same as in cssselect.
+NON_WHITESPACE_RE = re.compile(r"^[^ \t\r\n\f]+$")
+SAFE_NAME_RE = re.compile(r"^[a-zA-Z_][a-zA-Z0-9_.-]*$")
+
+
+def includes(attr, value):
+    return value in XPATH_SPACE_RE.split(attr)
+
+
+ATTRIB_TESTS = {
+    'exists': lambda attr, value: True,
+    '=': lambda attr, value: attr == value,
+    '~=': includes,
+    '|=': lambda attr, value: attr == value or attr.startswith(value + "-"),
+    '^=': lambda attr, value: attr.startswith(value),
+    '$=': lambda attr, value: attr.endswith(value),
+    '*=': lambda attr, value: value in attr,
+}
+
+# These never match with an empty value.
+NEED_VALUE = ('~=', '^=', '$=', '*=')
+
+
+class SimpleSelector(object):
+    """A selector made of an optional tag name and a list of attribute
+    tests, as (attribute name, operator, value)."""
+
+    def __init__(self, tag, tests):
+        self.tag = tag
+        self.tests = tests
+
+        # An impossible test, such as [class^=""].
+        self.never = any(not value and operator in NEED_VALUE or
+                         operator == '~=' and not NON_WHITESPACE_RE.match(value)
+                         for name, operator, value in tests)
+
+        # The most selective list of the index to start from, and the
+        # tests that list doesn't imply. The keys are, by preference:
+        # ('value', (name, value)) for [name=value] (including the
+        # id), ('class', name), ('prefix', (name, value)) for
+        # [name^=value], ('attr', name), ('tag', tag) and ('all', None).
+        self.key = ('tag', tag) if tag else ('all', None)
+        key_test = None
+        rank = 5
+        for test in tests:
+            name, operator, value = test
+            if operator == '=':
+                key, test_rank = ('value', (name, value)), 0
+            elif name == 'class' and operator == '~=':
+                key, test_rank = ('class', value), 1
+            elif operator == '^=':
+                key, test_rank = ('prefix', (name, value)), 2
+            else:
+                # Only implies the attribute exists.
+                key, test_rank = ('attr', name), 3
+            if test_rank < rank:
+                self.key, rank = key, test_rank
+                key_test = test if test_rank < 3 else None
+        self.rest = [test for test in tests if test is not key_test]
+
+    def match(self, element, tests=None):
+        """Whether an element matches, or only passes some of the
+        tests if given."""
+        if tests is None:
+            tests = self.tests
+            if self.tag and element.tag != self.tag:
+                return False
+        elif self.tag and self.key[0] != 'tag' and element.tag != self.tag:
+            return False
+        for name, operator, value in tests:
+            attr = element.get(name)
+            if attr is None or not ATTRIB_TESTS[operator](attr, value):
+                return False
+        return True
+
+
+def simple_selector(selector):
+    """Return a SimpleSelector for a cssselect Selector, or None if it
+    is not simple enough. The pseudo element is ignored, like
+    HTMLTranslator does."""
+    tests = []
+    tree = selector.parsed_tree
+
+    while True:
+        if isinstance(tree, cssselect.parser.Class):
+            tests.append(('class', '~=', tree.class_name))
+
+        elif isinstance(tree, cssselect.parser.Hash):
+            tests.append(('id', '=', tree.id))
+
+        elif isinstance(tree, cssselect.parser.Attrib):
+            if (tree.namespace or getattr(tree, 'flag', None) or
+                tree.operator not in ATTRIB_TESTS or
+                not SAFE_NAME_RE.match(tree.attrib)):
+                return None
+            # The value is a Token in recent versions of cssselect.
+            value = getattr(tree.value, 'value', tree.value)
+            tests.append((tree.attrib.lower(), tree.operator, value))
+
+        elif isinstance(tree, cssselect.parser.Element):
+            if tree.namespace:
+                return None
+            if not tree.element:
+                tag = None
+            elif SAFE_NAME_RE.match(tree.element):
+                tag = tree.element.lower()
+            else:
+                return None
+            break
+
+        else:
+            # Pseudo classes, combinators, ...
+            return None
+
+        tree = tree.selector
+
+    # The tests were found from the last one.
+    tests.reverse()
+    return SimpleSelector(tag, tests)
+
+
+class ElementIndex(object):
+    """The elements of a tree by tag, class and attribute, in
+    document order. The index is built on first use.
+
+    The tree may be changed between two searches, but the index must
+    be told with removed() or moved().
+    """
+
+    def __init__(self, tree):
+        self.tree = tree
+        self.built = False
+
+    def build(self):
+        self.all = []
+        self.tags = {}
+        self.classes = {}
+
+        # For each attribute name, the elements which have it and the
+        # values.
+        self.attrs = {}
+        self.values = {}
+
+        # Sorted (value, position in attrs) for each attribute, built
+        # when needed.
+        self.sorted_values = {}
+
+        for element in self.tree.iter(tag=etree.Element):
+            self.all.append(element)
+            self.tags.setdefault(element.tag, []).append(element)
+            for name, value in element.items():
+                self.attrs.setdefault(name, []).append(element)
+                self.values.setdefault(name, []).append(value)
+                if name == "class":
+                    for cls in set(XPATH_SPACE_RE.split(value)):
+                        if cls:
+                            self.classes.setdefault(cls, []).append(element)
+
+        self.built = True
+        self.has_removed = False
+
+    def with_value(self, name, value, prefix=False):
+        """Return the elements whose attribute name has that value, or
+        starts with it."""
+        if name not in self.sorted_values:
+            self.sorted_values[name] = sorted(
+                (v, i) for i, v in enumerate(self.values.get(name, [])))
+        sorted_values = self.sorted_values[name]
+
+        positions = []
+        for i in range(bisect.bisect_left(sorted_values, (value,)), len(sorted_values)):
+            v, position = sorted_values[i]
+            if v != value and not (prefix and v.startswith(value)):
+                break
+            positions.append(position)
+
+        # Back in document order.
+        positions.sort()
+        elements = self.attrs[name] if positions else []
+        return [elements[position] for position in positions]
+
+    def removed(self):
+        """Some elements were removed from the tree, or lost their
+        attributes."""
+        self.has_removed = True
+
+    def moved(self):
+        """Some elements were moved in the tree."""
+        self.built = False
+
+    def attached(self, element):
+        """Whether an element is still in the tree."""
+        root = element
+        for root in element.iterancestors():
+            pass
+        return root is self.tree.getroot()
+
+    def find(self, selector):
+        """Return the elements matching a SimpleSelector."""
+        if selector.never:
+            return []
+
+        if not self.built:
+            self.build()
+
+        kind, name = selector.key
+        if kind == 'all':
+            candidates = self.all
+        elif kind == 'tag':
+            candidates = self.tags.get(name, [])
+        elif kind == 'class':
+            candidates = self.classes.get(name, [])
+        elif kind == 'attr':
+            candidates = self.attrs.get(name, [])
+        else:
+            candidates = self.with_value(*name, prefix=(kind == 'prefix'))
+
+        if not self.has_removed:
+            if not selector.rest and (not selector.tag or selector.key[0] == 'tag'):
+                return list(candidates)
+            return [element for element in candidates
+                    if selector.match(element, selector.rest)]
+
+        # All the tests are done again, since attributes may have been
+        # removed since the index was built.
+        return [element for element in candidates
+                if selector.match(element) and self.attached(element)]
+
+
+def test_simple_selectors():
+    html = '''<html><head><title>t</title></head><body>
+    <p class="pagenum x">1</p><p class=" x&#9;pagenum2 ">2</p>
+    <span class="pagenum" id="Page_1">3</span><SPAN class="smcap">a</SPAN>
+    <div id="Page_2" lang="grc" title="b-c"><i>i</i><br/><td class="">x</td></div>
+    <!-- comment --><p class="x x">4</p></body></html>'''
+    tree = etree.ElementTree(etree.HTML(html))
+    translator = cssselect.HTMLTranslator()
+    index = ElementIndex(tree)
+
+    for css in ['i', 'SPAN', '*', '.x', '.pagenum', 'p.x', 'p.pagenum.x',
+                '#Page_1', 'div#Page_2', 'span[class^="pagenum"]',
+                'p[class^="page"]', '[class^=""]', '*[lang=grc]',
+                '[title|="b"]', '[title$="-c"]', '[title*="-"]',
+                '[class~="pagenum2"]', '[class~="a b"]', 'td[class]',
+                'div[id^="Page_"]', 'br:before', 'i:after']:
+        for selector in cssselect.parse(css):
+            simple = simple_selector(selector)
+            assert simple is not None, css
+            find = etree.XPath(translator.selector_to_xpath(selector))
+            assert index.find(simple) == find(tree), css
+
+    for css in ['p:first-child', 'div > i', 'div i', '[title!="b"]',
+                'svg|g']:
+        for selector in cssselect.parse(css):
+            assert simple_selector(selector) is None, css
+
+
+def test_tree_changes():
+    html = '<html><body><div class="a"><p class="a">1</p></div><p class="a">2</p></body></html>'
+    tree = etree.ElementTree(etree.HTML(html))
+    index = ElementIndex(tree)
+    selector = simple_selector(cssselect.parse('.a')[0])
+    assert len(index.find(selector)) == 3
+
+    # Removes the inner p, and the class of the div.
+    div = tree.find('.//div')
+    div.clear()
+    index.removed()
+    assert index.find(selector) == tree.xpath('//p[@class="a"]')
+
+    # Move the last p before the div
+    body = tree.find('.//body')
+    p = body[-1]
+    body.remove(p)
+    body.insert(0, p)
+    index.moved()
+    assert index.find(selector) == [p]
@@ -27,6 +27,124 @@
 import os
 from lxml import etree
 import re
+import copy
+import codecs
+import threading
+import functools
+from collections import OrderedDict
+
+# The XML declaration and the doctype are looked for in that many
+# bytes at the start of a file.
+SNIFF_SIZE = 4096
+
+DOCTYPE_RE = re.compile(rb"<!DOCTYPE[^>]*>", re.IGNORECASE)
+
+# Same test as lxml, which rejects such a declaration in a string.
+XML_ENCODING_RE = re.compile(rb"<\?xml[^>]+\s+encoding\s*=\s*[\"'][^\"']*[\"']")
+XML_DECLARATION_RE = re.compile(r"^<\?xml[^>]*\?>")
+DOCTYPE_IDS_RE = re.compile(rb"PUBLIC\s+[\"']([^\"']*)[\"']\s+[\"']([^\"']*)[\"']")
+
+# The XHTML namespace, and its declaration by the html element.
+XHTML_NAMESPACE = "http://www.w3.org/1999/xhtml"
+XHTML_XMLNS_RE = re.compile(r"<html\b[^>]*?\s(xmlns\s*=\s*([\"'])http://www\.w3\.org/1999/xhtml\2)")
+XHTML_XMLNS_BYTES_RE = re.compile(XHTML_XMLNS_RE.pattern.encode('ascii'))
+
+# A mirror of the XHTML DTDs and of the files they include, as
+# DTD_DIR/<host>/<path>. It is committed, and refreshed by
+# fetch_dtds.py.
+DTD_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       "..", "..", "data", "dtd")
+
+# The DTDs the mirror must have.
+XHTML_DTDS = [
+    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd",
+    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd",
+    "http://www.w3.org/TR/xhtml1/DTD/xhtml1-frameset.dtd",
+    "http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd",
+]
+
+# The DTDs are shared by all the threads, but lxml keeps the errors
+# of a validation in the DTD object.
+dtd_lock = threading.Lock()
+
+# How many parsed html files are kept by parsed_xhtml(), per process.
+PARSED_CACHE_SIZE = 8
+
+parsed_cache = OrderedDict()
+parsed_lock = threading.Lock()
+
+# Byte order marks, and their encoding. The UTF-32 ones come first,
+# since the little endian one starts like the UTF-16 one.
+BOMS = [(codecs.BOM_UTF32_LE, 'utf-32'),
+        (codecs.BOM_UTF32_BE, 'utf-32'),
+        (codecs.BOM_UTF8, 'utf-8'),
+        (codecs.BOM_UTF16_LE, 'utf-16'),
+        (codecs.BOM_UTF16_BE, 'utf-16')]
+
+NON_ASCII_RE = re.compile(rb"[\x80-\xff]")
+
+# Bytes of the printable characters of windows-1252, which are control
+# characters in iso-8859-1, and those that are not in windows-1252.
+# bytes.translate() deletes the others much faster than a regex finds
+# them.
+NOT_C1_BYTES = bytes(x for x in range(256) if not 0x80 <= x <= 0x9f)
+NOT_CP1252_BYTES = set(b"\x81\x8d\x8f\x90\x9d")
+
+WIDE_BOMS = tuple(bom for bom, enc in BOMS if enc != 'utf-8')
+
+# The encodings found by load_file(), by file, so they are not
+# looked for again.
+ENCODINGS_CACHE_SIZE = 1024
+
+known_encodings = OrderedDict()
+encodings_lock = threading.Lock()
+
+
+def detect_encoding(raw):
+    """Find the encoding of a file without a BOM: utf-8, windows-1252
+    or iso-8859-1.
+
+    utf-8 is only a guess, made from the first non-ASCII sequence: if
+    it is not valid, the file is not utf-8, and nothing else was
+    decoded.
+    """
+    if raw.isascii():
+        return 'utf-8'
+
+    # Find the first non-ASCII byte. isascii() is much faster than a
+    # regex.
+    start = 0
+    while raw[start:start + 65536].isascii():
+        start += 65536
+    m = NON_ASCII_RE.search(raw, start)
+
+    try:
+        # Up to 4 bytes for a character. A truncated one after it is
+        # not an error.
+        codecs.getincrementaldecoder('utf-8')().decode(raw[m.start():m.start() + 4])
+    except UnicodeDecodeError:
+        pass
+    else:
+        return 'utf-8'
+
+    return single_byte_encoding(raw)
+
+
+def single_byte_encoding(raw):
+    """windows-1252 if it has some of its characters and is valid,
+    else iso-8859-1."""
+    c1 = raw.translate(None, NOT_C1_BYTES)
+    if c1 and not NOT_CP1252_BYTES.intersection(c1):
+        return 'windows-1252'
+    return 'iso-8859-1'
+
+
+def is_single_byte(encoding):
+    """Whether an encoding is latin-1, or windows-1252, which
+    detect_encoding() finds for the latin-1 files with curly quotes or
+    dashes."""
+    return encoding in ('iso-8859-1', 'windows-1252')
+
 
 def clear_element(element):
     """In an XHTML tree, remove all sub-elements of a given element.
@@ -40,6 +158,167 @@ def clear_element(element):
     element.clear()
     element.tail = tail
 
+def local_dtd_file(url, directory=None):
+    """Return the file of the mirror for a DTD or entity URL, or None
+    if it is not there."""
+    directory = directory or DTD_DIR
+    if not url or not url.startswith(("http://", "https://")):
+        return None
+    filename = os.path.join(directory, url.split("://", 1)[1])
+    if os.path.isfile(filename):
+        return filename
+    return None
+
+
+class LocalDTDResolver(etree.Resolver):
+    """Load the DTDs, and the entities they include, from the mirror
+    instead of the network. Anything not in the mirror is left to
+    libxml2, i.e. to the XML catalog of the system."""
+
+    def __init__(self, directory=None):
+        super().__init__()
+        self.directory = directory
+
+    def resolve(self, url, public_id, context):
+        filename = local_dtd_file(url, self.directory)
+        if filename:
+            return self.resolve_filename(filename, context)
+        return None
+
+
+def missing_dtds(directory=None):
+    """The XHTML DTDs that are not in the mirror. The application
+    warns about them."""
+    return [url for url in XHTML_DTDS if local_dtd_file(url, directory) is None]
+
+
+@functools.lru_cache(maxsize=None)
+def load_dtd(public_id, system_url, directory=None):
+    """Load a DTD once per process, from the mirror, else from the XML
+    catalog of the system (e.g. w3c-sgml-lib). Returns None if it
+    cannot be found."""
+    try:
+        if local_dtd_file(system_url, directory):
+            # Through a document, so that the files the DTD includes
+            # by their URL are also taken from the mirror.
+            parser = etree.XMLParser(load_dtd=True, resolve_entities=True, no_network=True)
+            parser.resolvers.add(LocalDTDResolver(directory))
+            doc = etree.fromstring('<!DOCTYPE html PUBLIC "{0}" "{1}"><html/>'.format(public_id, system_url),
+                                   parser)
+            return doc.getroottree().docinfo.externalDTD
+        if public_id:
+            return etree.DTD(external_id=public_id.encode('ascii'))
+    except (etree.DTDParseError, UnicodeEncodeError):
+        pass
+    return None
+
+
+@functools.lru_cache(maxsize=None)
+def dtd_entities(public_id, system_url):
+    """The entities of a DTD, as the text of a DTD that only declares
+    them. Returns None if the DTD cannot be found."""
+    dtd = load_dtd(public_id, system_url)
+    if dtd is None:
+        return None
+
+    declarations = []
+    for entity in dtd.entities():
+        # Parameter entities, i.e. the included files, are already
+        # expanded. lxml also lists the other parameter entities,
+        # which the document doesn't need, and those referencing
+        # others would not parse on their own.
+        if entity.orig is None or "%" in entity.orig:
+            continue
+        quote = "'" if '"' in entity.orig else '"'
+        declarations.append("<!ENTITY {0} {1}{2}{1}>\n".format(entity.name, quote, entity.orig))
+    return "".join(declarations).encode('utf-8')
+
+
+class EntitiesResolver(etree.Resolver):
+    """Give a document the entities of its DTD, which are kept in
+    memory, instead of its DTD."""
+
+    def __init__(self, system_url, entities):
+        super().__init__()
+        self.system_url = system_url
+        self.entities = entities
+
+    def resolve(self, url, public_id, context):
+        if url == self.system_url:
+            return self.resolve_string(self.entities, context, base_url=url)
+        return None
+
+
+def blank_xhtml_namespace(source):
+    """Replace the XHTML namespace declaration of the html element
+    with spaces, in text or bytes, so that the line and column numbers
+    don't change."""
+    if isinstance(source, bytes):
+        m = XHTML_XMLNS_BYTES_RE.search(source)
+        space = b" "
+    else:
+        m = XHTML_XMLNS_RE.search(source)
+        space = " "
+    if m is None:
+        return source
+    return source[:m.start(1)] + space * (m.end(1) - m.start(1)) + source[m.end(1):]
+
+
+def strip_xhtml_namespace(tree):
+    """Remove the XHTML namespace from the tags of a tree (eg.
+    {http://www.w3.org/1999/xhtml}p), in a single walk. It is blanked
+    from the html element before parsing with a DTD of the mirror, but
+    any element can declare it too. lxml has no way to do it while
+    parsing: without the xmlns attribute, libxml2 takes it from the
+    DTD, and a transform loses the line numbers."""
+    prefix = "{" + XHTML_NAMESPACE + "}"
+    stripped = False
+    for element in tree.iter(prefix + "*"):
+        element.tag = element.tag[len(prefix):]
+        stripped = True
+
+    # The declarations are now unused.
+    if stripped:
+        etree.cleanup_namespaces(tree)
+
+
+def parsed_xhtml(name, encoding=None, relax=False):
+    """Load an html/xhtml file like SourceFile.load_xhtml(), unless it
+    was loaded recently and hasn't changed since.
+
+    Returns the SourceFile, which is shared and must not be modified,
+    and the exception raised by load_xhtml(), if any.
+    """
+    key = (os.path.abspath(name), encoding, relax)
+    try:
+        st = os.stat(name)
+    except OSError:
+        raise IOError("Cannot load file: " + os.path.basename(name))
+    stamp = (st.st_size, st.st_mtime_ns)
+
+    with parsed_lock:
+        entry = parsed_cache.get(key)
+        if entry is not None and entry[0] == stamp:
+            parsed_cache.move_to_end(key)
+            return entry[1], entry[2]
+
+    myfile = SourceFile()
+    try:
+        myfile.load_xhtml(name, encoding, relax)
+        error = None
+    except (IOError, SyntaxError) as e:
+        error = e
+
+    with parsed_lock:
+        # Replaces the older version of the file, if any.
+        parsed_cache[key] = (stamp, myfile, error)
+        parsed_cache.move_to_end(key)
+        while len(parsed_cache) > PARSED_CACHE_SIZE:
+            parsed_cache.popitem(last=False)
+
+    return myfile, error
+
+
 class SourceFile(object):
     """Represent a file in memory.
     """
@@ -56,23 +335,40 @@ class SourceFile(object):
         try:
             with open(fname, "rb") as f:
                 raw = f.read()
+                st = os.fstat(f.fileno())
         except Exception:
             raise IOError("Cannot load file: " + os.path.basename(fname))
 
         if len(raw) < 10:
             raise SyntaxError("File is too short: " + os.path.basename(fname))
 
-        # Remove BOM if present
-        if raw[0] == 0xef and raw[1] == 0xbb and raw[2] == 0xbf:
-            raw = raw[3:]
+        # Remove the BOM if it is a UTF-8 one. libxml2 needs the
+        # others, and the codecs skip them.
+        bom_encoding = None
+        for bom, enc in BOMS:
+            if raw.startswith(bom):
+                bom_encoding = enc
+                if enc == 'utf-8':
+                    raw = raw[len(bom):]
+                break
 
-        # Try various encodings. Much faster than using chardet
-        if encoding is None:
-            encodings = ['utf-8', 'iso-8859-1']
-        else:
+        # Find the encoding, then decode the file once, unless a file
+        # that looked like utf-8 isn't. Much faster than using chardet.
+        key = (os.path.abspath(fname), st.st_size, st.st_mtime_ns)
+        if encoding is not None:
             encodings = [encoding]
+        else:
+            with encodings_lock:
+                enc = known_encodings.get(key)
+            enc = enc or bom_encoding or detect_encoding(raw)
+            encodings = [enc]
+            if enc == 'utf-8':
+                encodings.append(None)
 
         for enc in encodings:
+            if enc is None:
+                # Not all utf-8 after all.
+                enc = single_byte_encoding(raw)
             try:
                 # Encode the raw data string into an internal unicode
                 # string, according to the discovered encoding.
@@ -80,6 +376,12 @@ class SourceFile(object):
             except Exception:
                 continue
             else:
+                if encoding is None:
+                    with encodings_lock:
+                        known_encodings[key] = enc
+                        known_encodings.move_to_end(key)
+                        while len(known_encodings) > ENCODINGS_CACHE_SIZE:
+                            known_encodings.popitem(last=False)
                 return raw, text, enc
 
         raise SyntaxError("Encoding cannot be found for: " +
@@ -124,62 +426,101 @@ class SourceFile(object):
 
     def parse_html_xhtml(self, name, raw, text, relax=False):
         """Parse a byte array. Find the correct parser. Returns both the
-        parser, which contains the error log, and the resulting tree,
-        if the parsing was successful.
+        error log of the parsing and of the validation, and the
+        resulting tree, if the parsing was successful.
+
+        The parser and what it parses are chosen once, from the start
+        of the file: the doctype gives the parser, and the raw bytes
+        are parsed instead of the decoded text only if an XML
+        declaration gives their encoding.
 
-        If relax is True, then the lax html parser is used, even for
-        XHTML, so the parsing will almost always succeed.
+        If relax is True, then the lax html parser is used when an
+        XHTML file fails to parse, so the parsing will almost always
+        succeed.
+
+        The strategy used is kept in self.parse_strategy, and why the
+        first parse failed, if it did, in self.parse_failure.
         """
 
-        parser = None
-        tree = None
+        self.parse_strategy = None
+        self.parse_failure = None
 
-        # Get the first 5 lines and find the DTD
-        header = text.splitlines()[:5]
+        if raw.startswith(WIDE_BOMS):
+            # Not ASCII compatible.
+            head = text[:SNIFF_SIZE].encode('utf-8')
+        else:
+            head = raw[:SNIFF_SIZE]
+        doctype = DOCTYPE_RE.search(head)
+        doctype = doctype.group(0) if doctype else b""
 
-        if any(["DTD XHTML" in x for x in header]):
-            parser = etree.XMLParser(dtd_validation=True)
-        if any(["DTD HTML" in x for x in header]):
+        if b"DTD HTML" in doctype:
             parser = etree.HTMLParser()
-
-        if parser is None:
+            kind = "html"
+            dtd = None
+        elif b"DTD XHTML" in doctype:
+            ids = DOCTYPE_IDS_RE.search(doctype)
+            ids = [x.decode('latin-1') for x in ids.groups()] if ids else None
+            dtd = load_dtd(*ids) if ids else None
+            if dtd is None:
+                # Let libxml2 find the DTD.
+                parser = etree.XMLParser(dtd_validation=True)
+            else:
+                # The document only gets the entities of its DTD, from
+                # memory, and is validated afterwards with the DTD
+                # already loaded.
+                parser = etree.XMLParser(load_dtd=True)
+                parser.resolvers.add(EntitiesResolver(ids[1], dtd_entities(*ids)))
+            kind = "xhtml"
+        else:
             raise SyntaxError("No parser found for that type of document: " +
                               os.path.basename(name))
 
-        # Try the decoded file first.
-        try:
-            tree = etree.fromstring(text, parser)
-        except etree.XMLSyntaxError:
-            if relax == False:
-                return parser, tree
-        except Exception:
-            pass
+        # lxml refuses decoded text with an encoding declaration.
+        if XML_ENCODING_RE.match(head):
+            source = raw
+            self.parse_strategy = kind + "-raw"
         else:
-            return parser, tree
+            source = text
+            self.parse_strategy = kind + "-text"
+
+        if kind == "xhtml" and dtd is not None:
+            # The tags are then parsed without a namespace. The
+            # entities DTD doesn't give one back to the html element.
+            source = blank_xhtml_namespace(source)
 
-        # Try raw string. This will decode files with <?xml ...
         try:
-            tree = etree.fromstring(raw, parser)
-        except etree.XMLSyntaxError:
+            tree = etree.fromstring(source, parser)
+            if dtd is not None:
+                with dtd_lock:
+                    valid = dtd.validate(tree.getroottree())
+                    errors = dtd.error_log.copy()
+                if not valid:
+                    self.parse_failure = str(errors.last_error)
+                    if relax == False:
+                        return errors, None
+                    tree = None
+            if tree is not None:
+                return parser.error_log, tree
+        except etree.XMLSyntaxError as e:
+            self.parse_failure = str(e)
             if relax == False:
-                return parser, tree
-        except Exception:
-            pass
-        else:
-            return parser, tree
+                return parser.error_log, None
+        except Exception as e:
+            self.parse_failure = str(e)
 
         # The XHTML file may have some errors. If the caller really
         # wants a result then use the HTML parser.
-        if relax and any(["DTD XHTML" in x for x in header]):
+        if relax and kind == "xhtml":
+            self.parse_strategy += ", html-relaxed"
             parser = etree.HTMLParser()
             try:
-                tree = etree.fromstring(text, parser)
+                tree = etree.fromstring(XML_DECLARATION_RE.sub("", text, count=1), parser)
             except etree.XMLSyntaxError:
-                return parser, tree
+                return parser.error_log, None
             except Exception:
                 pass
             else:
-                return parser, tree
+                return parser.error_log, tree
 
         raise SyntaxError("File cannot be parsed: " +
                           os.path.basename(name))
@@ -202,23 +543,23 @@ class SourceFile(object):
         if raw is None:
             raise IOError("File loading failed for: " + os.path.basename(name))
 
-        parser, tree = self.parse_html_xhtml(name, raw, text, relax)
+        error_log, tree = self.parse_html_xhtml(name, raw, text, relax)
 
-        self.parser_errlog = parser.error_log
+        self.parser_errlog = error_log
         self.encoding = encoding
         self.count_ending_empty_lines(text)
 
         if len(self.parser_errlog):
             # Cleanup some errors
-            #print(parser.error_log[0].domain_name)
-            #print(parser.error_log[0].type_name)
-            #print(parser.error_log[0].level_name)
+            #print(error_log[0].domain_name)
+            #print(error_log[0].type_name)
+            #print(error_log[0].level_name)
 
-            if type(parser) == etree.HTMLParser:
+            if self.parse_strategy.split(", ")[-1].startswith("html"):
                 # HTML parser rejects tags with both id and name
                 #   (513 == DTD_ID_REDEFINED)
-                self.parser_errlog = [x for x in parser.error_log
-                                      if parser.error_log[0].type != 513]
+                self.parser_errlog = [x for x in error_log
+                                      if error_log[0].type != 513]
 
         if len(self.parser_errlog):
             raise SyntaxError("Parsing errors in document: " +
@@ -235,10 +576,11 @@ class SourceFile(object):
         else:
             self.xmlns = ""
 
-        # Remove the namespace from the tags
-        # (eg. {http://www.w3.org/1999/xhtml})
-        for element in self.tree.iter(tag=etree.Element):
-            element.tag = element.tag.replace(self.xmlns, "")
+        # Remove the XHTML namespace from the tags. The html parser
+        # doesn't set any, so there is nothing to do for html files
+        # and relaxed xhtml files.
+        if not self.parse_strategy.split(", ")[-1].startswith("html"):
+            strip_xhtml_namespace(self.tree)
 
         # Find type of xhtml (10 or 11 for 1.0 and 1.1). 0=html or
         # unknown. So far, no need to differentiate 1.0 strict and
@@ -266,6 +608,23 @@ class SourceFile(object):
                 clear_element(element)
 
 
+    def load_xhtml_cached(self, name, encoding=None, relax=False, readonly=False):
+        """Same as load_xhtml(), through parsed_xhtml(). The tree and
+        the text are copies, so they can be modified, unless readonly
+        is set, in which case they are shared with parsed_xhtml()."""
+        myfile, error = parsed_xhtml(name, encoding, relax)
+
+        self.__dict__.update(myfile.__dict__)
+        if not readonly:
+            if myfile.tree is not None:
+                self.tree = copy.deepcopy(myfile.tree)
+            if myfile.text is not None:
+                self.text = list(myfile.text)
+
+        if error is not None:
+            raise type(error)(*error.args)
+
+
     def load_text(self, fname, encoding=None):
         """Load the file as text."""
         raw, text, encoding = self.load_file(fname, encoding)
@@ -356,3 +715,241 @@ def test_load_xhtml_text2():
     assert myfile.tree == None
     assert myfile.text == None
     assert len(myfile.parser_errlog) == 3
+
+def test_parse_strategy():
+    myfile = SourceFile()
+    myfile.load_xhtml("data/testfiles/34332-h.htm")
+    assert myfile.parse_strategy == "html-text"
+    assert myfile.parse_failure is None
+
+    # No doctype.
+    raw = b"<html><body><p>text</p></body></html>"
+    try:
+        myfile.parse_html_xhtml("nodoctype.html", raw, raw.decode())
+    except SyntaxError:
+        pass
+    else:
+        raise AssertionError("no parser should be found")
+
+def test_local_dtd():
+    global DTD_DIR
+    import tempfile
+
+    # A mirror with a small DTD, which includes its entities and
+    # modules like the XHTML DTDs do.
+    with tempfile.TemporaryDirectory() as directory:
+        dtd_dir = os.path.join(directory, "www.w3.org", "TR", "xhtml1", "DTD")
+        os.makedirs(dtd_dir)
+        module_dir = os.path.join(directory, "www.w3.org", "MarkUp", "DTD")
+        os.makedirs(module_dir)
+        with open(os.path.join(dtd_dir, "xhtml1-strict.dtd"), "w") as f:
+            f.write('<!ENTITY % lat1 SYSTEM "xhtml-lat1.ent"> %lat1;\n'
+                    '<!ENTITY % head SYSTEM "http://www.w3.org/MarkUp/DTD/head.mod"> %head;\n'
+                    '<!ELEMENT html (head, body)>\n'
+                    '<!ATTLIST html xmlns CDATA #FIXED "http://www.w3.org/1999/xhtml">\n'
+                    '<!ELEMENT body (p*)>\n'
+                    '<!ELEMENT p (#PCDATA)>\n'
+                    '<!ATTLIST p xmlns CDATA #FIXED "http://www.w3.org/1999/xhtml">\n')
+        with open(os.path.join(module_dir, "head.mod"), "w") as f:
+            f.write('<!ELEMENT head (title)>\n'
+                    '<!ELEMENT title (#PCDATA)>\n')
+        with open(os.path.join(dtd_dir, "xhtml-lat1.ent"), "w") as f:
+            f.write('<!ENTITY nbsp "&#160;">\n')
+
+        xhtml = ('<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Strict//EN" '
+                 '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd">\n'
+                 '<html xmlns="http://www.w3.org/1999/xhtml"><head><title>t</title></head>'
+                 '<body><p>a&nbsp;b</p>{0}</body></html>\n')
+
+        saved = DTD_DIR
+        DTD_DIR = directory
+        load_dtd.cache_clear()
+        dtd_entities.cache_clear()
+        try:
+            myfile = SourceFile()
+            text = xhtml.format("")
+            error_log, tree = myfile.parse_html_xhtml("valid.html", text.encode(), text)
+            assert len(error_log) == 0
+            assert tree.findtext(".//p") == "a\u00a0b"
+
+            # Validated with the same DTD object.
+            dtd = load_dtd("-//W3C//DTD XHTML 1.0 Strict//EN",
+                           "http://www.w3.org/TR/xhtml1/DTD/xhtml1-strict.dtd")
+            assert dtd is not None
+            text = xhtml.format("<div/>")
+            error_log, tree = myfile.parse_html_xhtml("invalid.html", text.encode(), text)
+            assert tree is None and len(error_log)
+            assert load_dtd.cache_info().misses == 1
+            assert "div" in myfile.parse_failure
+
+            # The entities are now in memory.
+            os.remove(os.path.join(dtd_dir, "xhtml-lat1.ent"))
+            valid = xhtml.format("")
+            error_log, tree = myfile.parse_html_xhtml("valid.html", valid.encode(), valid)
+            assert tree.findtext(".//p") == "a\u00a0b"
+
+            error_log, tree = myfile.parse_html_xhtml("invalid.html", text.encode(), text, relax=True)
+            assert tree is not None
+            assert myfile.parse_strategy == "xhtml-text, html-relaxed"
+
+            # Parsed without the namespace, at the same place.
+            xhtml_ns = xhtml.replace("<html ", "\n<html\n  ")
+            valid = xhtml_ns.format("")
+            error_log, tree = myfile.parse_html_xhtml("valid.html", valid.encode(), valid)
+            assert len(error_log) == 0
+            assert tree.tag == "html" and tree.sourceline == 4
+            assert tree.find("head").sourceline == 4
+
+            # An element may declare the namespace too.
+            name = os.path.join(directory, "nested.html")
+            with open(name, "w") as f:
+                f.write(xhtml.format('<p xmlns="http://www.w3.org/1999/xhtml">c</p>'))
+            myfile.load_xhtml(name)
+            assert myfile.parse_strategy == "xhtml-text"
+            assert [p.text for p in myfile.tree.iter("p")] == ["a\u00a0b", "c"]
+            assert not any(element.nsmap for element in myfile.tree.iter())
+        finally:
+            DTD_DIR = saved
+            load_dtd.cache_clear()
+            dtd_entities.cache_clear()
+
+def test_xhtml11_offline():
+    # With the DTDs of the mirror, which libxml2 is not allowed to
+    # fetch from the network.
+    if missing_dtds():
+        import pytest
+        pytest.skip("The DTDs are missing from data/dtd: run 'make dtds'")
+
+    xhtml = ('<?xml version="1.0" encoding="utf-8"?>\n'
+             '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.1//EN" '
+             '"http://www.w3.org/TR/xhtml11/DTD/xhtml11.dtd">\n'
+             '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en">\n'
+             '<head><title>t</title></head>\n'
+             '<body><p>a&nbsp;b&mdash;c</p>{0}</body></html>\n')
+
+    myfile = SourceFile()
+    text = xhtml.format("")
+    error_log, tree = myfile.parse_html_xhtml("valid.html", text.encode(), text)
+    assert tree is not None and len(error_log) == 0
+    assert myfile.parse_strategy == "xhtml-raw"
+    assert tree.findtext(".//p") == "a\u00a0b\u2014c"
+
+    text = xhtml.format("<center/>")
+    error_log, tree = myfile.parse_html_xhtml("invalid.html", text.encode(), text)
+    assert tree is None and "center" in myfile.parse_failure
+
+def test_blank_xhtml_namespace():
+    source = '<html\n xmlns="http://www.w3.org/1999/xhtml" lang="en"><p xmlns="http://www.w3.org/1999/xhtml"/></html>'
+    blank = '<html\n' + ' ' * 38 + 'lang="en"><p xmlns="http://www.w3.org/1999/xhtml"/></html>'
+    assert blank_xhtml_namespace(source) == blank
+    assert blank_xhtml_namespace(source.encode()) == blank.encode()
+
+    source = '<html xmlns="http://www.w3.org/1999/xhtml/other"></html>'
+    assert blank_xhtml_namespace(source) == source
+
+def test_strip_xhtml_namespace():
+    source = ('<html xmlns="http://www.w3.org/1999/xhtml"><body>'
+              '<div xmlns="http://www.w3.org/1999/xhtml"><p>a</p></div>'
+              '<svg xmlns="http://www.w3.org/2000/svg"><g/></svg></body></html>')
+    tree = etree.fromstring(source).getroottree()
+    strip_xhtml_namespace(tree)
+    assert [element.tag for element in tree.iter()] == [
+        "html", "body", "div", "p", "{http://www.w3.org/2000/svg}svg", "{http://www.w3.org/2000/svg}g"]
+    assert tree.getroot().nsmap == {}
+
+    # Only declared by an inner element.
+    source = '<html><body><div xmlns="http://www.w3.org/1999/xhtml"><p>a</p></div></body></html>'
+    tree = etree.fromstring(source).getroottree()
+    strip_xhtml_namespace(tree)
+    assert tree.find("body/div/p").text == "a"
+    assert etree.tostring(tree) == b'<html><body><div><p>a</p></div></body></html>'
+
+def test_load_xhtml_cached():
+    import shutil
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        name = os.path.join(directory, "34332-h.htm")
+        shutil.copy("data/testfiles/34332-h.htm", name)
+
+        myfile1 = SourceFile()
+        myfile1.load_xhtml_cached(name)
+        assert myfile1.basename == '34332-h.htm'
+        assert len(myfile1.text) == 489
+
+        # Parsed once, but each copy can be modified.
+        myfile2 = SourceFile()
+        myfile2.load_xhtml_cached(name)
+        assert parsed_xhtml(name)[0].tree is not myfile1.tree
+        assert myfile1.tree is not myfile2.tree
+        body = myfile1.tree.find("body")
+        clear_element(body)
+        assert len(myfile2.tree.find("body"))
+        assert len(parsed_xhtml(name)[0].tree.find("body"))
+
+        # Or shared, when only read.
+        myfile4 = SourceFile()
+        myfile4.load_xhtml_cached(name, readonly=True)
+        assert myfile4.tree is parsed_xhtml(name)[0].tree
+        assert myfile4.text is parsed_xhtml(name)[0].text
+
+        # Reloaded once modified.
+        shared = parsed_xhtml(name)[0]
+        with open(name, "ab") as f:
+            f.write(b"\n")
+        os.utime(name, ns=(0, 0))
+        myfile3 = SourceFile()
+        myfile3.load_xhtml_cached(name)
+        assert myfile3.ending_empty_lines == 5
+        assert parsed_xhtml(name)[0] is not shared
+
+        # The errors are kept too.
+        name = os.path.join(directory, "badxhtml.html")
+        shutil.copy("data/testfiles/badxhtml.html", name)
+        for i in range(2):
+            myfile = SourceFile()
+            try:
+                myfile.load_xhtml_cached(name)
+            except SyntaxError:
+                pass
+            else:
+                raise AssertionError("badxhtml.html should not parse")
+            assert myfile.tree is None and len(myfile.parser_errlog)
+
+def test_load_file_encodings():
+    import tempfile
+
+    html = '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN">\n<html><body><p>{0}</p></body></html>\n'
+    cases = [
+        ("été", 'utf-8', 'utf-8'),
+        ("été", 'iso-8859-1', 'iso-8859-1'),
+        ("“quoted” été", 'windows-1252', 'windows-1252'),
+        # 0x81 is not in windows-1252.
+        ("\u0081 été", 'iso-8859-1', 'iso-8859-1'),
+        ("été", 'utf-8-sig', 'utf-8'),
+        ("été α", 'utf-16', 'utf-16'),
+        ("été α", 'utf-32', 'utf-32'),
+    ]
+
+    with tempfile.TemporaryDirectory() as directory:
+        name = os.path.join(directory, "file.htm")
+        for text, codec, encoding in cases:
+            with open(name, "wb") as f:
+                f.write(html.format(text).encode(codec))
+            myfile = SourceFile()
+            myfile.load_xhtml(name)
+            assert myfile.encoding == encoding
+            assert is_single_byte(encoding) == (codec in ('iso-8859-1', 'windows-1252'))
+            assert myfile.tree.findtext(".//p") == text
+            assert myfile.text[0].startswith("<!DOCTYPE")
+
+        # utf-8 at the start only.
+        with open(name, "wb") as f:
+            f.write(html.format("été").encode('utf-8') + "été".encode('iso-8859-1'))
+        raw, text, encoding = SourceFile().load_file(name)
+        assert encoding == 'iso-8859-1'
+        assert text.endswith("Ã©tÃ©</p></body></html>\nété")
+
+        # Found once.
+        key = (os.path.abspath(name), os.stat(name).st_size, os.stat(name).st_mtime_ns)
+        assert known_encodings[key] == 'iso-8859-1'
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+
+# Timings of the stages of a comparison. Part of comp_pp
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+"""
+Timings of the stages of a comparison. Part of comp_pp.
+
+For each stage (loading a file, applying the CSS, diffing, ...), the
+wall time, the CPU time of the thread running it, the resident memory
+of the process at its start and end, and how much it raised the peak
+memory of the process are recorded. Each stage is also logged as a
+line of key=value pairs, on the "comp_pp.timings" logger.
+
+The CPU time of child processes, such as dwdiff, is not counted. The
+memory is that of the whole process, which includes the memory used
+by libxml2, and the stages running at the same time in other threads
+count too. The peak memory is the high-water mark of the process since
+it started: a stage only raises it if it needs more memory than
+anything before it, so in a long-lived web process the growth is
+mostly 0, and is not the memory used by the stage.
+"""
+
+import os
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    # Not on Windows.
+    resource = None
+
+logger = logging.getLogger("comp_pp.timings")
+
+
+def peak_memory():
+    """Peak resident memory of the process so far, in MB, or None if
+    unknown."""
+    if resource is None:
+        return None
+    # In kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def current_memory():
+    """Resident memory of the process now, in MB, or None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        # Not on Linux.
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+
+
+def memory_usage():
+    """The resident and peak memory of the process now."""
+    return current_memory(), peak_memory()
+
+
+def format_memory(memory):
+    return "" if memory is None else "{0:.1f}".format(memory)
+
+
+class Stage(object):
+    """The measures of one stage. detail is the file name, or the part
+    of the diff, if the stage is about one of them. rss_start and
+    rss_end are the resident memory of the process at the start and
+    end of the stage, and peak_growth the growth of the peak memory of
+    the process during the stage, all in MB."""
+
+    def __init__(self, name, detail, wall, cpu, rss_start, rss_end, peak_growth):
+        self.name = name
+        self.detail = detail
+        self.wall = wall
+        self.cpu = cpu
+        self.rss_start = rss_start
+        self.rss_end = rss_end
+        self.peak_growth = peak_growth
+
+    def __str__(self):
+        text = "stage={0} detail={1!r} wall={2:.3f} cpu={3:.3f}".format(
+            self.name, self.detail, self.wall, self.cpu)
+        if self.rss_end is not None:
+            text += " rss_start_mb={0:.1f} rss_end_mb={1:.1f}".format(
+                self.rss_start, self.rss_end)
+        if self.peak_growth is not None:
+            text += " process_peak_growth_mb={0:.1f}".format(self.peak_growth)
+        return text
+
+
+class Timings(object):
+    """The stages of a comparison, in the order they ended. Stages can
+    run in several threads at the same time."""
+
+    def __init__(self):
+        self.stages = []
+        self.lock = threading.Lock()
+
+    def add(self, name, detail, wall, cpu, memory):
+        """Record a stage. memory is the memory_usage() at its start."""
+        rss_start, peak = memory
+        rss_end = current_memory()
+        if peak is not None:
+            peak = peak_memory() - peak
+        stage = Stage(name, detail, wall, cpu, rss_start, rss_end, peak)
+        with self.lock:
+            self.stages.append(stage)
+        logger.info("%s", stage)
+
+    @contextmanager
+    def stage(self, name, detail=""):
+        """Record the code run in a with block as a stage."""
+        memory = memory_usage()
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, detail,
+                     time.perf_counter() - wall,
+                     time.thread_time() - cpu,
+                     memory)
+
+    def iterate(self, name, iterable, detail=""):
+        """Iterate over iterable, recording the time spent producing
+        the items as a stage. The time spent by the caller between
+        items is not counted, but its memory is."""
+        memory = memory_usage()
+        wall = cpu = 0
+        iterator = iter(iterable)
+        try:
+            while True:
+                wall_start = time.perf_counter()
+                cpu_start = time.thread_time()
+                try:
+                    item = next(iterator)
+                finally:
+                    wall += time.perf_counter() - wall_start
+                    cpu += time.thread_time() - cpu_start
+                yield item
+        except StopIteration:
+            pass
+        finally:
+            self.add(name, detail, wall, cpu, memory)
+
+    def text(self):
+        """The stages, as a table."""
+        lines = ["{0:<20} {1:<30} {2:>9} {3:>9} {4:>12} {5:>12} {6:>13}".format(
+            "stage", "detail", "wall (s)", "cpu (s)", "rss start MB",
+            "rss end MB", "proc peak +MB")]
+        for stage in self.stages:
+            lines.append("{0:<20} {1:<30} {2:>9.3f} {3:>9.3f} {4:>12} {5:>12} {6:>13}".format(
+                stage.name, stage.detail, stage.wall, stage.cpu,
+                format_memory(stage.rss_start), format_memory(stage.rss_end),
+                format_memory(stage.peak_growth)))
+        return "\n".join(lines)
+
+    def html(self):
+        """The stages, as a collapsed html table."""
+        html = "<details class='timings'><summary>Timings</summary><table>"
+        html += ("<tr><th>Stage</th><th></th><th>Wall (s)</th><th>CPU (s)</th>"
+                 "<th>Resident memory at start (MB)</th><th>at end (MB)</th>"
+                 "<th>Process peak memory growth (MB)</th></tr>")
+        for stage in self.stages:
+            html += ("<tr><td>{0}</td><td>{1}</td><td>{2:.3f}</td><td>{3:.3f}</td>"
+                     "<td>{4}</td><td>{5}</td><td>{6}</td></tr>").format(
+                stage.name,
+                stage.detail.replace("&", "&amp;").replace("<", "&lt;"),
+                stage.wall, stage.cpu,
+                format_memory(stage.rss_start), format_memory(stage.rss_end),
+                format_memory(stage.peak_growth))
+        return html + "</table></details>"
+
+
+def test_timings():
+    timings = Timings()
+
+    with timings.stage("sleep", "a.txt"):
+        time.sleep(0.02)
+
+    # Only the time spent producing the items counts.
+    def items():
+        for i in range(3):
+            time.sleep(0.01)
+            yield i
+    result = []
+    for item in timings.iterate("items", items()):
+        time.sleep(0.05)
+        result.append(item)
+    assert result == [0, 1, 2]
+
+    # Stages are recorded even on error.
+    try:
+        with timings.stage("error"):
+            raise ValueError
+    except ValueError:
+        pass
+
+    sleep, produce, error = timings.stages
+    assert sleep.name == "sleep" and sleep.detail == "a.txt"
+    assert 0.02 <= sleep.wall and sleep.cpu < sleep.wall
+    assert 0.03 <= produce.wall < 0.15
+    assert error.name == "error"
+
+    # The peak memory grows with the stages needing more memory than
+    # the previous ones, while the resident memory is that of each
+    # stage.
+    if peak_memory() is not None:
+        with timings.stage("memory"):
+            data = bytearray(64 * 1024 * 1024)
+            data[::4096] = b"x" * len(data[::4096])
+        with timings.stage("again"):
+            data = bytearray(16 * 1024 * 1024)
+            data[::4096] = b"x" * len(data[::4096])
+        del data
+        memory, again = timings.stages[-2:]
+        assert memory.peak_growth >= 32
+        assert again.peak_growth < 32
+        if current_memory() is not None:
+            assert memory.rss_end - memory.rss_start >= 32
+            assert again.rss_start >= again.rss_end + 32
+        del timings.stages[-2:]
+
+    assert "a.txt" in timings.text().splitlines()[1]
+    assert timings.html().count("<tr>") == 4
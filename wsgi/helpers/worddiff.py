@@ -0,0 +1,916 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+
+# Word diff. Part of comp_pp
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+# MA 02110-1301, USA.
+
+"""
+Word diff. Part of comp_pp.
+
+Replacement for running "dwdiff -P -R -C 2 -L" with the COMPPP
+markers. The texts are split into words and punctuation, each word is
+given an integer id, and the two lists of ids are compared with a
+histogram diff. Large regions are first split around the words
+unique to both texts (patience diff), and Myers is used when no good
+anchor exists. The result is
+formatted the way dwdiff does it, so create_html can consume it
+unchanged.
+"""
+
+import re
+import os
+import threading
+import multiprocessing
+from bisect import bisect_left
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import Counter
+from itertools import accumulate, chain, compress, repeat
+
+START_DEL = "]COMPPP_START_DEL["
+STOP_DEL = "]COMPPP_STOP_DEL["
+START_INS = "]COMPPP_START_INS["
+STOP_INS = "]COMPPP_STOP_INS["
+
+# A word, or a single punctuation character (like dwdiff -P). Only
+# whitespaces are left between them.
+TOKEN_RE = re.compile(r"([^\W_]+|\S)")
+
+# Ignore tokens appearing more often than that when looking for an
+# anchor in the histogram diff.
+MAX_CHAIN = 64
+
+# Regions larger than that are first split with the patience
+# algorithm.
+PATIENCE_MIN = 256
+
+# Give up on Myers after that many edits, and consider the region
+# entirely replaced.
+MAX_MYERS_D = 500
+
+# Chunked diff: lines shorter than that are never anchors, and chunks
+# are at least that many lines long.
+ANCHOR_MIN_LENGTH = 20
+CHUNK_LINES = 1000
+
+# The pools of chunk_executor(), by number of processes, with the
+# number of diffs using them and the timer shutting them down. A pool
+# has at most MAX_CHUNK_PROCESSES processes, and is shut down once no
+# diff used it for POOL_IDLE seconds.
+MAX_CHUNK_PROCESSES = 4
+POOL_IDLE = 60
+executors = {}
+executors_lock = threading.Lock()
+
+# Identical lines kept around the differing part of two texts, so the
+# context of the first and last differences doesn't change.
+TRIM_MARGIN = 10
+
+
+def tokenize(text, ids, ignore_case=False):
+    """Split a text into words. Returns the whitespaces preceding each
+    word, the words, their ids and the trailing whitespaces. ids is a
+    dictionary shared by both texts, mapping a word to its id.
+    """
+    # Splitting gives [spaces, word, spaces, word, ..., spaces]
+    tokens = TOKEN_RE.split(text)
+    spaces = tokens[0:-1:2]
+    words = tokens[1::2]
+
+    if ignore_case:
+        keys = list(map(str.lower, words))
+    else:
+        keys = words
+
+    # Number the new words only.
+    for word in dict.fromkeys(keys):
+        if word not in ids:
+            ids[word] = len(ids)
+    keys = list(map(ids.__getitem__, keys))
+
+    return spaces, words, keys, tokens[-1]
+
+
+def myers_diff(a, b, a_lo, a_hi, b_lo, b_hi):
+    """Myers O(ND) diff on a region. Returns a list of matching
+    blocks (i, j, 1), or None if there are more than MAX_MYERS_D
+    edits.
+    """
+    n = a_hi - a_lo
+    m = b_hi - b_lo
+    max_d = min(n + m, MAX_MYERS_D)
+    off = max_d + 1
+    v = [0] * (2 * max_d + 3)
+    trace = []
+
+    for d in range(max_d + 1):
+        trace.append(v[:])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[off + k - 1] < v[off + k + 1]):
+                x = v[off + k + 1]
+            else:
+                x = v[off + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[a_lo + x] == b[b_lo + y]:
+                x += 1
+                y += 1
+            v[off + k] = x
+
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    else:
+        return None
+
+    # Walk back the trace to find the matching tokens.
+    blocks = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[off + k - 1] < v[off + k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[off + prev_k]
+        prev_y = prev_x - prev_k
+
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            blocks.append((a_lo + x, b_lo + y, 1))
+
+        x, y = prev_x, prev_y
+
+    return blocks
+
+
+def unique_anchors(a, b, a_lo, a_hi, b_lo, b_hi):
+    """Patience step. Find the ids appearing only once in both regions,
+    and keep the longest sequence of them appearing in the same order.
+    Returns a list of (i, j).
+    """
+    count_a = Counter(a[a_lo:a_hi])
+    count_b = Counter(b[b_lo:b_hi])
+    pos_a = {x: i for i, x in enumerate(a[a_lo:a_hi], a_lo)}
+
+    pairs = [(pos_a[x], j) for j, x in enumerate(b[b_lo:b_hi], b_lo)
+             if count_b[x] == 1 and count_a.get(x) == 1]
+
+    # Longest increasing subsequence on the positions in a.
+    tails = []
+    tails_idx = []
+    prev = [None] * len(pairs)
+    for n, (i, j) in enumerate(pairs):
+        k = bisect_left(tails, i)
+        if k:
+            prev[n] = tails_idx[k - 1]
+        if k == len(tails):
+            tails.append(i)
+            tails_idx.append(n)
+        else:
+            tails[k] = i
+            tails_idx[k] = n
+
+    anchors = []
+    n = tails_idx[-1] if tails_idx else None
+    while n is not None:
+        anchors.append(pairs[n])
+        n = prev[n]
+    anchors.reverse()
+
+    return anchors
+
+
+def histogram_diff(a, b):
+    """Compare two lists of ids. Returns the sorted list of matching
+    blocks (i, j, n), meaning a[i:i+n] == b[j:j+n].
+    """
+    blocks = []
+    regions = [(0, len(a), 0, len(b))]
+
+    while regions:
+        a_lo, a_hi, b_lo, b_hi = regions.pop()
+
+        # Common prefix and suffix
+        start = a_lo
+        while a_lo < a_hi and b_lo < b_hi and a[a_lo] == b[b_lo]:
+            a_lo += 1
+            b_lo += 1
+        if a_lo > start:
+            blocks.append((start, b_lo - (a_lo - start), a_lo - start))
+
+        end = a_hi
+        while a_lo < a_hi and b_lo < b_hi and a[a_hi - 1] == b[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+        if a_hi < end:
+            blocks.append((a_hi, b_hi, end - a_hi))
+
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+
+        # On large regions, first split around the unique ids. The
+        # remaining regions are small.
+        if a_hi - a_lo > PATIENCE_MIN and b_hi - b_lo > PATIENCE_MIN:
+            anchors = unique_anchors(a, b, a_lo, a_hi, b_lo, b_hi)
+            if anchors:
+                for i, j in anchors:
+                    blocks.append((i, j, 1))
+                    regions.append((a_lo, i, b_lo, j))
+                    a_lo, b_lo = i + 1, j + 1
+                regions.append((a_lo, a_hi, b_lo, b_hi))
+                continue
+
+        # Index the occurrences of each id in the first region.
+        index = {}
+        for i in range(a_lo, a_hi):
+            index.setdefault(a[i], []).append(i)
+
+        # Find the longest common run holding the rarest id.
+        best = None
+        best_count = MAX_CHAIN + 1
+        best_len = 0
+        j = b_lo
+        while j < b_hi:
+            next_j = j + 1
+            positions = index.get(b[j])
+            if positions is not None and len(positions) <= best_count:
+                for i in positions:
+                    count = len(positions)
+                    s_a, s_b = i, j
+                    while s_a > a_lo and s_b > b_lo and a[s_a - 1] == b[s_b - 1]:
+                        s_a -= 1
+                        s_b -= 1
+                        count = min(count, len(index[a[s_a]]))
+                    e_a, e_b = i + 1, j + 1
+                    while e_a < a_hi and e_b < b_hi and a[e_a] == b[e_b]:
+                        count = min(count, len(index[a[e_a]]))
+                        e_a += 1
+                        e_b += 1
+
+                    if count < best_count or (count == best_count and e_a - s_a > best_len):
+                        best = (s_a, s_b)
+                        best_count = count
+                        best_len = e_a - s_a
+
+                    next_j = max(next_j, e_b)
+            j = next_j
+
+        if best is None:
+            # No good anchor. Only try Myers, which may give up on very
+            # different regions.
+            myers = myers_diff(a, b, a_lo, a_hi, b_lo, b_hi)
+            if myers:
+                blocks.extend(myers)
+            continue
+
+        s_a, s_b = best
+        blocks.append((s_a, s_b, best_len))
+        regions.append((a_lo, s_a, b_lo, s_b))
+        regions.append((s_a + best_len, a_hi, s_b + best_len, b_hi))
+
+    blocks.sort()
+
+    # Regroup adjacent blocks
+    merged = []
+    for block in blocks:
+        if merged:
+            i, j, n = merged[-1]
+            if i + n == block[0] and j + n == block[1]:
+                merged[-1] = (i, j, n + block[2])
+                continue
+        merged.append(block)
+
+    return merged
+
+
+def get_opcodes(blocks, len_a, len_b):
+    """Convert matching blocks into a list of ('equal'|'delete'|'insert',
+    i1, i2, j1, j2) operations, similar to difflib. A deletion is
+    always listed before the corresponding insertion.
+    """
+    opcodes = []
+    i = j = 0
+    for bi, bj, n in blocks + [(len_a, len_b, 0)]:
+        if i < bi:
+            opcodes.append(('delete', i, bi, j, j))
+        if j < bj:
+            opcodes.append(('insert', bi, bi, j, bj))
+        if n:
+            opcodes.append(('equal', bi, bi + n, bj, bj + n))
+        i = bi + n
+        j = bj + n
+
+    return opcodes
+
+
+class DiffRenderer(object):
+    """Build the output lines, with their line numbers, from the diff
+    operations.
+    """
+
+    def __init__(self):
+        self.old_line = 1
+        self.new_line = 1
+        self.lines = []
+        self.segments = []
+        self.line_start = (1, 1)
+
+    def emit(self, kind, text, old_step=0, new_step=0):
+        """Add some text. kind is 'eq', 'del' or 'ins'. Each new line
+        advances the line numbers by old_step and new_step."""
+        parts = text.split("\n")
+        for n, part in enumerate(parts):
+            if n:
+                self.newline(self.old_line + old_step, self.new_line + new_step)
+            if part:
+                self.segments.append((kind, part))
+
+    def newline(self, old_line, new_line):
+        """Start a new line, at the given line numbers."""
+        self.old_line = old_line
+        self.new_line = new_line
+        self.lines.append((self.line_start, self.segments))
+        self.segments = []
+        self.line_start = (old_line, new_line)
+
+    def spaces(self, kind, text, old_line, new_line):
+        """Add the whitespaces before a word, given the line numbers
+        (starting at 0) of that word in each text. Each newline moves
+        both texts one line further, but never past the line of the
+        word, which both reach on the last newline."""
+        parts = text.split("\n")
+        old_start, new_start = self.old_line, self.new_line
+        old_end, new_end = old_line + 1, new_line + 1
+        for n, part in enumerate(parts):
+            if n:
+                left = len(parts) - 1 - n
+                self.newline(min(old_end, max(old_start + n, old_end - left)),
+                             min(new_end, max(new_start + n, new_end - left)))
+            if part:
+                self.segments.append((kind, part))
+
+    def trailing(self, text1, text2):
+        """Add the whitespaces that end the texts. text1 is shown, but
+        each line number only moves as far as its own text goes."""
+        new_end = self.new_line + text2.count("\n")
+        parts = text1.split("\n")
+        for n, part in enumerate(parts):
+            if n:
+                self.newline(self.old_line + 1, min(self.new_line + 1, new_end))
+            if part:
+                self.segments.append(('eq', part))
+
+    def finish(self):
+        if self.segments:
+            self.lines.append((self.line_start, self.segments))
+            self.segments = []
+
+
+def format_line(segments):
+    """Create the line, surrounding changes with the markers. Like
+    dwdiff -R, the markers are repeated on each line."""
+    line = ""
+    for kind, text in segments:
+        if kind == "del":
+            line += START_DEL + text + STOP_DEL
+        elif kind == "ins":
+            line += START_INS + text + STOP_INS
+        else:
+            line += text
+
+    # Join consecutive changes of the same kind.
+    line = line.replace(STOP_DEL + START_DEL, "")
+    line = line.replace(STOP_INS + START_INS, "")
+
+    return line
+
+
+def line_numbers(spaces):
+    """Line number (starting at 0) of each word."""
+    return list(accumulate(map(str.count, spaces, repeat("\n"))))
+
+
+def word_diff(text1, text2, ignore_case=False, context=2):
+    """Compare two texts. The output has the same format as "dwdiff -P
+    -R -C <context> -L" with the COMPPP markers. Returns an empty
+    string if there is no difference.
+    """
+    return format_hunks(diff_hunks(text1, text2, ignore_case, context))
+
+
+def diff_hunks(text1, text2, ignore_case=False, context=2):
+    """Compare two texts. Returns the list of diff sections, each one
+    being a list of lines (line number in text1, line number in text2,
+    line with the markers)."""
+    ids = {}
+    sp1, w1, k1, tail1 = tokenize(text1, ids, ignore_case)
+    sp2, w2, k2, tail2 = tokenize(text2, ids, ignore_case)
+
+    opcodes = get_opcodes(histogram_diff(k1, k2), len(k1), len(k2))
+
+    if all(op[0] == 'equal' for op in opcodes):
+        return []
+
+    lines1 = line_numbers(sp1)
+    lines2 = line_numbers(sp2)
+
+    # Words starting a new line in the first text.
+    breaks1 = list(compress(range(len(sp1)), map(str.__contains__, sp1, repeat("\n"))))
+
+    def words1(start, end):
+        return "".join(chain.from_iterable(zip(sp1[start:end], w1[start:end])))
+
+    # Line of the word at a position, or of the end of the last word.
+    def line1(i):
+        return lines1[i] if i < len(lines1) else (lines1[-1] if lines1 else 0)
+
+    def line2(j):
+        return lines2[j] if j < len(lines2) else (lines2[-1] if lines2 else 0)
+
+    r = DiffRenderer()
+    before = previous = None
+    for op, i1, i2, j1, j2 in opcodes:
+
+        if op == 'equal':
+            pos = i1
+            if previous == 'insert' and before != 'delete':
+                # Separate from the inserted words with the
+                # whitespaces of the second text.
+                r.spaces('eq', sp2[j1], lines1[i1], lines2[j1])
+                r.emit('eq', w1[i1])
+                pos = i1 + 1
+
+            # Keep the whitespaces from the first text, but follow the
+            # line numbers of both. Only the words starting a line
+            # need to be looked at.
+            for i in breaks1[bisect_left(breaks1, pos):bisect_left(breaks1, i2)]:
+                r.emit('eq', words1(pos, i))
+                r.spaces('eq', sp1[i], lines1[i], lines2[i - i1 + j1])
+                r.emit('eq', w1[i])
+                pos = i + 1
+            r.emit('eq', words1(pos, i2))
+
+        elif op == 'delete':
+            r.spaces('eq', sp1[i1], lines1[i1], line2(j1))
+            r.emit('del', w1[i1])
+            for i in range(i1 + 1, i2):
+                r.spaces('del', sp1[i], lines1[i], line2(j1))
+                r.emit('del', w1[i])
+
+        else:
+            if previous == 'delete':
+                # Separate from the deleted words.
+                if sp2[j1]:
+                    r.emit('eq', " ")
+            else:
+                r.spaces('eq', sp2[j1], line1(i1), lines2[j1])
+            r.emit('ins', w2[j1])
+            for j in range(j1 + 1, j2):
+                r.spaces('ins', sp2[j], line1(i1), lines2[j])
+                r.emit('ins', w2[j])
+
+        before, previous = previous, op
+
+    r.trailing(tail1, tail2)
+    r.finish()
+
+    return select_hunks(r.lines, context)
+
+
+def select_hunks(lines, context):
+    """Keep only the changed lines and their context, grouped like
+    dwdiff -C."""
+
+    changed = [n for n, (_, segments) in enumerate(lines)
+               if any(kind != 'eq' for kind, _ in segments)]
+
+    hunks = []
+    hunk = None
+    last = -1
+    for n in changed:
+        first = max(n - context, last + 1)
+        if hunk is None or first > last + 1:
+            hunk = []
+            hunks.append(hunk)
+        for x in range(first, min(n + context + 1, len(lines))):
+            if x > last:
+                (old, new), segments = lines[x]
+                hunk.append((old, new, format_line(segments)))
+                last = x
+
+    return hunks
+
+
+def format_hunks(hunks):
+    """Output the diff sections like dwdiff -L, separated by "--"."""
+    return "".join(format_hunk_lines(hunks))
+
+
+def format_hunk_lines(hunks, width=None):
+    """Same as format_hunks(), one line at a time. hunks can be an
+    iterator if the width of the line numbers is given."""
+    if width is None:
+        if not hunks:
+            return
+
+        # Width of the line numbers
+        width = len(str(max(max(old, new) for old, new, _ in hunks[-1])))
+
+    for n, hunk in enumerate(hunks):
+        if n:
+            yield "--\n"
+        for old, new, line in hunk:
+            yield "{0:>{2}}:{1:<{2}} {3}\n".format(old, new, width, line)
+
+
+def find_cuts(lines1, lines2, ignore_case=False, context=2):
+    """Find where both texts can be cut into aligned chunks. The cuts
+    are on lines present only once in each text, long enough, and in
+    the same order in both. The context lines on each side of a cut
+    must have the same words in both texts, so that no diff section
+    is cut. Cutting just after a section break (empty lines, usually
+    before a chapter heading) is preferred. Returns a list of (line in
+    text1, line in text2), starting at 0.
+    """
+    # Short lines get a different id on each side, so they never
+    # match.
+    ids = {}
+    def line_ids(lines, short_id):
+        keys = []
+        for line in lines:
+            line = line.strip()
+            if len(line) < ANCHOR_MIN_LENGTH:
+                keys.append(short_id)
+                continue
+            if ignore_case:
+                line = line.lower()
+            keys.append(ids.setdefault(line, len(ids)))
+        return keys
+
+    keys1 = line_ids(lines1, -1)
+    keys2 = line_ids(lines2, -2)
+
+    def after_break(lines, n):
+        return n >= 2 and not lines[n - 1].strip() and not lines[n - 2].strip()
+
+    def words(line):
+        return (line.lower() if ignore_case else line).split()
+
+    # An insertion among the empty lines before a cut is numbered
+    # after the next word, which is across the cut. So these lines are
+    # part of the context.
+    def same_context(i, j):
+        start = i
+        while start and not lines1[start - 1].strip():
+            start -= 1
+        start -= context
+        if start < 0 or start - i + j < 0 or i + context > len(lines1) or j + context > len(lines2):
+            return False
+        return all(words(lines1[n]) == words(lines2[n - i + j])
+                   for n in range(start, i + context))
+
+    cuts = []
+    start1 = start2 = 0
+    for i, j in unique_anchors(keys1, keys2, 0, len(keys1), 0, len(keys2)):
+        size = min(i - start1, j - start2)
+        if size < CHUNK_LINES or not same_context(i, j):
+            continue
+        if size >= 2 * CHUNK_LINES or (after_break(lines1, i) and after_break(lines2, j)):
+            cuts.append((i, j))
+            start1, start2 = i, j
+
+    return cuts
+
+
+def chunk_executor(processes=None, broken=None):
+    """The pool of processes that diff the chunks, started on first use
+    and shared by the diffs of the process. The broken pool, whose
+    process died, is replaced, unless it was already. Each call must
+    be followed by release_executor().
+
+    The processes are started by a server process, not forked from the
+    threads of the web application, which may hold locks."""
+    processes = min(processes or os.cpu_count() or 1, MAX_CHUNK_PROCESSES)
+    with executors_lock:
+        entry = executors.get(processes)
+        if entry is None or entry[0] is broken:
+            if entry is not None:
+                entry[0].shutdown(wait=False)
+            context = multiprocessing.get_context("forkserver")
+            executor = ProcessPoolExecutor(max_workers=processes,
+                                           mp_context=context)
+            entry = executors[processes] = [executor, 0, None]
+        entry[1] += 1
+        if entry[2] is not None:
+            entry[2].cancel()
+            entry[2] = None
+        return entry[0]
+
+
+def release_executor(executor):
+    """A diff is done with a pool. The last one starts the timer that
+    shuts it down."""
+    with executors_lock:
+        for entry in executors.values():
+            if entry[0] is executor:
+                break
+        else:
+            # Replaced meanwhile.
+            return
+        entry[1] -= 1
+        if entry[1] == 0:
+            entry[2] = threading.Timer(POOL_IDLE, shutdown_idle, (executor,))
+            entry[2].daemon = True
+            entry[2].start()
+
+
+def shutdown_idle(executor):
+    """Shut down a pool, unless a diff started using it again."""
+    with executors_lock:
+        for processes, entry in list(executors.items()):
+            if entry[0] is executor and entry[1] == 0:
+                del executors[processes]
+                executor.shutdown(wait=False)
+
+
+def diff_chunk(chunk):
+    """Diff one chunk. Run in a worker process."""
+    text1, text2, ignore_case, context = chunk
+    return diff_hunks(text1, text2, ignore_case, context)
+
+
+def chunked_diff(text1, text2, ignore_case=False, context=2, processes=None):
+    """Same as word_diff(), but cut both texts into aligned chunks,
+    diffed in parallel. A misalignment can't go past the end of its
+    chunk. Otherwise the output is the same, except that between
+    equally good alignments of repeated words, near a cut, another one
+    may be picked. The line numbers of the diff sections are then
+    shifted to their place in the texts, and the sections that touch
+    across a cut are joined.
+    """
+    return format_hunks(chunked_hunks(text1, text2, ignore_case, context, processes))
+
+
+def chunked_hunks(text1, text2, ignore_case=False, context=2, processes=None):
+    """Same as diff_hunks(), for chunked_diff()."""
+    return list(iter_chunked_hunks(text1, text2, ignore_case, context, processes))
+
+
+def iter_chunked_hunks(text1, text2, ignore_case=False, context=2, processes=None):
+    """Same as chunked_hunks(), but an iterator. The hunks of a chunk
+    are given as soon as it and the chunks before it are diffed."""
+    lines1 = text1.split("\n")
+    lines2 = text2.split("\n")
+
+    bounds = [(0, 0)] + find_cuts(lines1, lines2, ignore_case, context) + [(len(lines1), len(lines2))]
+    if len(bounds) == 2:
+        yield from diff_hunks(text1, text2, ignore_case, context)
+        return
+
+    chunks = []
+    for (start1, start2), (end1, end2) in zip(bounds, bounds[1:]):
+        chunks.append(("\n".join(lines1[start1:end1]),
+                       "\n".join(lines2[start2:end2]),
+                       ignore_case, context))
+
+    executor = chunk_executor(processes)
+    try:
+        futures = [executor.submit(diff_chunk, chunk) for chunk in chunks]
+    except BrokenProcessPool:
+        release_executor(executor)
+        executor = chunk_executor(processes, broken=executor)
+        futures = [executor.submit(diff_chunk, chunk) for chunk in chunks]
+    try:
+        # The last hunk of a chunk is kept until the next one is
+        # known: their contexts may touch across the cut.
+        previous = None
+        for (start1, start2), future in zip(bounds, futures):
+            for hunk in shift_hunks(future.result(), start1, start2):
+                if previous and (previous[-1][0] + 1, previous[-1][1] + 1) == hunk[0][:2]:
+                    previous += hunk
+                    continue
+                if previous:
+                    yield previous
+                previous = hunk
+        if previous:
+            yield previous
+    finally:
+        # The iterator may not be used to the end.
+        for future in futures:
+            future.cancel()
+        release_executor(executor)
+
+
+def shift_hunk(hunk, start1, start2):
+    """Shift the line numbers of a hunk by start1 and start2."""
+    return [(old + start1, new + start2, line) for old, new, line in hunk]
+
+
+def shift_hunks(hunks, start1, start2):
+    """Shift the line numbers of hunks by start1 and start2."""
+    return [shift_hunk(hunk, start1, start2) for hunk in hunks]
+
+
+def trim_common_lines(text1, text2, margin=TRIM_MARGIN):
+    """Remove the lines both texts start with, and the lines they both
+    end with, except for margin of them next to the differing part.
+    Returns the number of lines removed at the start, and what is left
+    of each text.
+    """
+    lines1 = text1.split("\n")
+    lines2 = text2.split("\n")
+    shortest = min(len(lines1), len(lines2))
+
+    start = 0
+    while start < shortest and lines1[start] == lines2[start]:
+        start += 1
+
+    end = 0
+    while end < shortest - start and lines1[-1 - end] == lines2[-1 - end]:
+        end += 1
+
+    start = max(start - margin, 0)
+    end = max(end - margin, 0)
+    if not start and not end:
+        return 0, text1, text2
+
+    return (start,
+            "\n".join(lines1[start:len(lines1) - end]),
+            "\n".join(lines2[start:len(lines2) - end]))
+
+
+def show(diff):
+    """The diff with short markers, for the tests."""
+    return (diff.replace(START_DEL, "[-").replace(STOP_DEL, "-]")
+            .replace(START_INS, "{+").replace(STOP_INS, "+}"))
+
+
+def test_word_diff_identical():
+    assert word_diff("Lorem ipsum dolor.\nSit amet.", "Lorem ipsum  dolor.\nSit amet.") == ""
+    assert word_diff("", "") == ""
+
+
+def test_word_diff_change():
+    text1 = "a\nb\nc\nd\nThe quick fox.\ne\nf\ng\nh"
+    text2 = "a\nb\nc\nd\nThe slow fox!\ne\nf\ng\nh"
+    diff = word_diff(text1, text2)
+
+    # Only one section, with 2 lines of context
+    assert "\n--\n" not in diff
+    assert len(diff.splitlines()) == 5
+    assert "The " + START_DEL + "quick" + STOP_DEL + " " + START_INS + "slow" + STOP_INS + " fox" in diff
+    assert START_DEL + "." + STOP_DEL in diff
+    assert diff.splitlines()[2].startswith("5:5 ")
+
+
+def test_word_diff_sections():
+    text1 = "\n".join(["line " + str(i) for i in range(20)])
+    text2 = text1.replace("line 2", "line two").replace("line 15", "line fifteen")
+    diff = word_diff(text1, text2)
+    assert diff.count("\n--\n") == 1
+    assert re.search(r"^\s*16:16 *line " + re.escape(START_DEL), diff, re.MULTILINE)
+
+    lines = list(format_hunk_lines(diff_hunks(text1, text2)))
+    assert "".join(lines) == diff
+    assert lines.count("--\n") == 1
+    assert list(format_hunk_lines([])) == []
+
+
+def test_word_diff_case_and_lines():
+    assert word_diff("Hello World", "hello world", ignore_case=True) == ""
+    assert word_diff("Hello World", "hello world") != ""
+
+    # Insertion of a line shifts the line numbers of the second text
+    text1 = "one\ntwo\nthree\nfour\nfive"
+    text2 = "one\ntwo\nextra\nthree\nfour\nfive"
+    diff = word_diff(text1, text2)
+    assert START_INS + "extra" + STOP_INS in diff
+    assert "4:5 four" in diff
+
+
+def test_word_diff_line_start():
+    # A word replaced at the start of a line.
+    assert show(word_diff("a\nb\nc\n", "a\nB\nc\n")) == "1:1 a\n2:2 [-b-] {+B+}\n3:3 c\n"
+    lines = ["line {0}".format(n) for n in range(1, 13)]
+    text1 = "\n".join(lines)
+    lines[10] = "other 11"
+    diff = word_diff(text1, "\n".join(lines))
+    assert "\n11:11 [-line-] {+other+} 11\n" in show(diff)
+
+    # Lines removed or added.
+    assert show(word_diff("a\nb\nc\n", "a\nc\n")) == "1:1 a\n2:2 [-b-]\n3:2 c\n"
+    assert show(word_diff("a\nc\n", "a\nb\nc\n")) == "1:1 a\n2:2 {+b+}\n2:3 c\n"
+    assert show(word_diff("a\n\nb\nX", "a\nb\nY")).endswith("\n3:2 b\n4:3 [-X-] {+Y+}\n")
+
+    # A change at the start of the text.
+    assert show(word_diff("a b c", "x a b c")) == "1:1 {+x+} a b c\n"
+    assert show(word_diff("x a b c", "a b c")) == "1:1 [-x-] a b c\n"
+    assert show(word_diff("a", "x\na")) == "1:1 {+x+}\n1:2 a\n"
+
+
+def test_word_diff_trailing_spaces():
+    # The line numbers stay in their text.
+    assert show(word_diff("a b\n\n", "a b\n\nc")) == "1:1 a b\n1:2 \n1:3 {+c+}\n2:3 \n"
+    assert show(word_diff("a\n\n\n", "b")) == "1:1 [-a-]{+b+}\n2:1 \n3:1 \n"
+
+    for text1, text2 in [("a b  ", "a b c\n"), ("a\n \n ", "x a"), ("a\n\n\n", "a\n\nb\n\n")]:
+        for diff in (word_diff(text1, text2), word_diff(text2, text1)):
+            for line in diff.splitlines():
+                old, new = map(int, line.split()[0].split(":"))
+                assert old <= max(text1.count("\n"), text2.count("\n")) + 1
+        for hunk in diff_hunks(text1, text2):
+            for old, new, _ in hunk:
+                assert old <= text1.count("\n") + 1 and new <= text2.count("\n") + 1
+
+
+def test_chunked_diff():
+    # A book with chapters, each with a unique heading.
+    lines = []
+    for chapter in range(8):
+        lines += ["", "", "", "", "CHAPTER {0}: A LONG ENOUGH HEADING".format(chapter), ""]
+        lines += ["Line {0} of chapter {1}.".format(n, chapter) for n in range(300)]
+    text1 = "\n".join(lines)
+
+    lines[10] = "Line 4 of chapter zero."
+    lines[-10] = "Line 290 of the last chapter."
+    text2 = "\n".join(lines)
+
+    cuts = find_cuts(text1.split("\n"), text2.split("\n"))
+    assert cuts and all(text1.split("\n")[i].startswith("CHAPTER") for i, j in cuts)
+
+    assert chunked_diff(text1, text2, processes=2) == word_diff(text1, text2)
+    assert chunked_diff(text1, text1, processes=2) == ""
+
+    # The processes are kept for the next diffs, until the pool is
+    # idle.
+    executor = chunk_executor(2)
+    assert chunk_executor(2) is executor
+    release_executor(executor)
+    shutdown_idle(executor)
+    assert 2 in executors
+    release_executor(executor)
+    shutdown_idle(executor)
+    assert 2 not in executors
+
+    # Changes next to a cut move it.
+    for n in (-3, -6, 1):
+        lines = text1.split("\n")
+        lines[cuts[0][0] + n] = "Next to the cut."
+        assert cuts[0] not in find_cuts(text1.split("\n"), lines)
+        text3 = "\n".join(lines)
+        assert chunked_diff(text1, text3, processes=2) == word_diff(text1, text3)
+
+    # The first hunk comes before the last chunk is diffed.
+    hunks = iter_chunked_hunks(text1, text2, processes=1)
+    assert next(hunks)[0][0] == 9
+    hunks.close()
+
+    # Without section breaks. The sections on each side of a cut touch,
+    # and are joined.
+    lines = ["Line {0} of the text.".format(n) for n in range(2 * CHUNK_LINES + 500)]
+    text1 = "\n".join(lines)
+    lines[2 * CHUNK_LINES - 3] = "Before the cut."
+    lines[2 * CHUNK_LINES + 2] = "After the cut."
+    text2 = "\n".join(lines)
+    assert find_cuts(text1.split("\n"), lines) == [(2 * CHUNK_LINES, 2 * CHUNK_LINES)]
+    assert chunked_diff(text1, text2, processes=2) == word_diff(text1, text2)
+    assert "--" not in chunked_diff(text1, text2, processes=2)
+
+
+def test_trim_common_lines():
+    lines = ["Line {0}.".format(n) for n in range(100)]
+    text1 = "\n".join(lines)
+    lines[40] = "Line forty."
+    lines.insert(60, "A new line.")
+    text2 = "\n".join(lines)
+
+    start, middle1, middle2 = trim_common_lines(text1, text2)
+    assert start == 40 - TRIM_MARGIN
+    assert middle1.split("\n")[0] == "Line {0}.".format(start)
+    assert middle1.split("\n")[-1] == middle2.split("\n")[-1] == "Line 69."
+
+    hunks = diff_hunks(middle1, middle2)
+    assert shift_hunks(hunks, start, start) == diff_hunks(text1, text2)
+
+    # Nothing to remove
+    assert trim_common_lines("a\nb", "c\nb", margin=1) == (0, "a\nb", "c\nb")
+    assert trim_common_lines("a\nb", "a\nb\nc", margin=0) == (2, "", "c")
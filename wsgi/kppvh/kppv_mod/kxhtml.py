@@ -12,6 +12,7 @@ import re
 import os
 
 from helpers import k_unicode
+from helpers.sourcefile import is_single_byte
 
 # The xml: prefix is equivalent to the following
 XMLNS = "{http://www.w3.org/XML/1998/namespace}"
@@ -123,6 +124,7 @@ class KXhtml(object):
         # will be valid.
         self.sel_unchecked = []
         self.sel_unused = []
+        used_classes = {}
         for selector in css_selectors:
 
             # Get the selector (eg. "body", "p", ".some_class")
@@ -152,9 +154,10 @@ class KXhtml(object):
             if len(cl) == 0:
                 continue
 
-            # Mark the class wherever it is used, in each element
+            # Mark the class wherever it is used, in each element.
+            # The tree may be shared, so it is not marked itself.
             for item in occurences:
-                item.attrib['__used_classes'] = item.attrib.get('__used_classes', '') + ' ' + cl
+                used_classes.setdefault(item, set()).add(cl)
 
         # Look for unused classes
         self.classes_undefined = []
@@ -162,11 +165,9 @@ class KXhtml(object):
         for element in find(myfile.tree):
             classes = set(element.attrib['class'].split())
 
-            used_classes = element.attrib.get('__used_classes', None)
-            if used_classes:
-                # Substract content of used_classes from classes
-                # leaving classes that were not matched.
-                classes -= set(used_classes.split())
+            # Substract the used classes from classes leaving classes
+            # that were not matched.
+            classes -= used_classes.get(element, set())
 
             # Finally, create the warning
             for cl in classes:
@@ -340,6 +341,11 @@ class KXhtml(object):
                         # not ascii
                         pass
 
+                # A latin-1 file with curly quotes or dashes is
+                # read as windows-1252.
+                if is_single_byte(self.meta_encoding) and is_single_byte(myfile.encoding):
+                    badenc = False
+
                 if badenc:
                     self.encoding_errors.append("Document encoded with {} but declared encoding is {}".format(myfile.encoding, self.meta_encoding))
 
@@ -576,6 +582,26 @@ def test_html2():
     assert myfile.encoding == 'utf-8'
     assert len(x.encoding_errors) == 0
 
+def test_html_cp1252():
+    import tempfile
+    from sourcefile import SourceFile
+
+    # Declared as latin-1, with curly quotes from windows-1252.
+    html = ('<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01//EN">\n'
+            '<html><head><meta http-equiv="Content-Type" content="text/html; charset=iso-8859-1">'
+            '<title>t</title></head><body><p>\x93Quoted\x94 \xe9t\xe9</p></body></html>\n')
+    with tempfile.NamedTemporaryFile(suffix=".html") as f:
+        f.write(html.encode('latin-1'))
+        f.flush()
+        myfile = SourceFile()
+        myfile.load_xhtml(f.name)
+
+    x = KXhtml()
+    x.check_document(myfile)
+    assert myfile.encoding == 'windows-1252'
+    assert x.meta_encoding == 'iso-8859-1'
+    assert len(x.encoding_errors) == 0
+
 def test_html2():
     """Test all document errors, as long as the document is valid."""
     from sourcefile import SourceFile
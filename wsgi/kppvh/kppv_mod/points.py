@@ -15,12 +15,10 @@ class KPoints(object):
 
     def check_points(self, myfile):
 
-        # Transform html into text - get rid of <head> content first.
-        head = myfile.tree.find('head')
-        tail = head.tail
-        head.clear()
-        head.tail = tail
-        text = etree.XPath("normalize-space(/)")(myfile.tree)
+        # Transform html into text - without the <head> content. The
+        # tree may be shared, so the <head> is not cleared.
+        text = ''.join(etree.XPath("//text()[not(ancestor::head)]")(myfile.tree))
+        text = ' '.join(re.split(r'[ \t\r\n]+', text.strip(' \t\r\n')))
 
         self.point_matches = []
 
@@ -120,6 +118,9 @@ def test_kpoints():
     assert("dot. or" in kp.point_matches)
     assert(len(kp.point_matches) == 2)
 
+    # The tree is unchanged.
+    assert(myfile.tree.find('head').find('title') is not None)
+
 
 if __name__ == '__main__':
 
@@ -123,7 +123,7 @@ class Kppvh(object):
             return self.process_text(myfile, project_id)
         elif basename.lower().endswith((".htm", ".html")):
             try:
-                myfile.load_xhtml(fname)
+                myfile.load_xhtml_cached(fname, readonly=True)
             except Exception:
                 pass
             return self.process_html(myfile, project_id)
@@ -17,8 +17,12 @@
 
 import os
 import time
-from flask import Flask, abort, request, redirect, url_for, render_template, send_from_directory
+import json
+import argparse
+import pickle
+from flask import Flask, abort, request, redirect, url_for, render_template, stream_template, send_from_directory, jsonify
 from werkzeug.utils import secure_filename
+from markupsafe import escape
 from itertools import combinations
 from wtforms import Form, BooleanField, TextAreaField, SelectField
 from itertools import zip_longest
@@ -28,7 +32,12 @@ import shutil
 
 import sys
 sys.path.append("../pptools")
-from comp_pp import diff_css, CompPP, html_usage, DEFAULT_TRANSFORM_CSS
+from comp_pp import diff_css, CompPP, html_usage, render_hunk, DEFAULT_TRANSFORM_CSS, DWDIFF_TIMEOUT
+
+from helpers.cache import DiskCache, file_digest, options_digest
+
+from helpers import minhash
+from helpers.sourcefile import missing_dtds
 
 import kppvh
 import find_langs
@@ -43,6 +52,48 @@ ALLOWED_EXTENSIONS = sorted(['.txt', '.htm', '.html'])
 ALLOWED_UPLOAD_EXTENSIONS = sorted(ALLOWED_EXTENSIONS + ['.zip'])
 PROJECT_FILES = "files"
 
+# The diff page only shows the first hunks of a diff. The others are
+# fetched from diffs.json when the page is scrolled, at most
+# MAX_JSON_HUNKS at a time. They are kept in the cache by pages of
+# DIFF_PAGE_SIZE hunks.
+DIFF_PAGE_SIZE = 50
+MAX_JSON_HUNKS = 200
+DIFF_PARTS = ("text", "footnotes")
+
+# At most that many files are compared by diffs_all, i.e. 66 pairs.
+MAX_DIFFS_ALL_FILES = 12
+
+# Work that the pages don't wait for, such as the diffs of all the
+# pairs, is queued in the directory of
+# the project, and done by run_jobs.py, outside of the web server
+# processes. The pages show what is already in the cache. A job is
+# identified by a cache key, and only queued once at a time. The jobs
+# of a lower priority, e.g. the preparation of the files, are all done
+# before those of the next one.
+QUEUE_DIR = "queue"
+JOB_PRIORITY = {"prepare_file": 0,
+                "diff_pair": 1}
+
+
+def background(project_dir, key, fn, *args):
+    """Queue fn(*args) for run_jobs.py, unless it is already queued
+    for that key. The jobs store their result, or their failure, in
+    the cache."""
+    queue_dir = os.path.join(project_dir, QUEUE_DIR)
+    os.makedirs(queue_dir, exist_ok=True)
+
+    name = "{0}-{1}.job".format(JOB_PRIORITY[fn.__name__], key)
+    path = os.path.join(queue_dir, name)
+    if os.path.exists(path):
+        return
+
+    # By name, since the application may run as __main__.
+    tmp = path + "." + str(os.getpid())
+    with open(tmp, "wb") as f:
+        pickle.dump((fn.__name__, args), f)
+    os.replace(tmp, path)
+
+
 def create_new_project():
 
     # Create an 16 hex characters ID
@@ -71,7 +122,9 @@ def check_project_id(project_id):
     return project_dir
 
 def extract_zip(project_dir, zipname):
+    """Extract the files of a zip file, and return their names."""
 
+    filenames = []
     try:
         with zipfile.ZipFile(zipname, 'r') as myzip:
             for zipf in myzip.infolist():
@@ -83,10 +136,13 @@ def extract_zip(project_dir, zipname):
                 if ext in ALLOWED_EXTENSIONS:
                     with myzip.open(zipf) as source, open(os.path.join(project_dir, "files", filename), "wb") as target:
                         shutil.copyfileobj(source, target)
+                    filenames.append(filename)
 
     except Exception:
         pass
 
+    return filenames
+
 
 @app.route('/comp_pp/diff-default-css.txt')
 def send_diff_default_css():
@@ -155,13 +211,24 @@ def project(project_id):
         # Sort them again by alphabetical order
         files.sort()
 
+        # How close each pair of files is.
+        cache = DiskCache(os.path.join(project_dir, "cache"))
+        form = DiffForm()
+        signatures = {f[0]: file_signature(project_dir, cache, form, f[0])
+                      for f in files}
+        similarities = {}
+        for f1, f2 in combinations(sorted(signatures), 2):
+            if signatures[f1] and signatures[f2]:
+                similarities[(f1, f2)] = minhash.similarity(signatures[f1], signatures[f2])
+
         return render_template('project.tmpl',
                                project_id=project_id,
                                files=files,
                                files_html=[x for x in files if x[0].lower().endswith((".htm", ".html"))],
                                files_txt=[x for x in files if x[0].lower().endswith((".txt"))],
                                allowed_ext=", ".join(ALLOWED_UPLOAD_EXTENSIONS),
-                               combos=combos)
+                               combos=combos,
+                               similarities=similarities)
 
     elif request.method == 'POST':
 
@@ -176,14 +243,49 @@ def project(project_id):
             if ext in ALLOWED_UPLOAD_EXTENSIONS:
                 dest_name = os.path.join(project_dir, "files", filename)
                 upfile.save(dest_name)
+                new_files = [filename]
                 # If it's a zip file, unzip them
                 if ext == ".zip":
-                    extract_zip(project_dir, dest_name)
+                    new_files = extract_zip(project_dir, dest_name)
                     os.unlink(dest_name)
 
+                # The signatures of the new files, for the project page.
+                cache = DiskCache(os.path.join(project_dir, "cache"))
+                form = DiffForm()
+                for filename in new_files:
+                    file_signature(project_dir, cache, form, filename)
+
         return redirect(url_for('project', project_id=project_id))
 
 
+def file_signature(project_dir, cache, form, filename):
+    """The signature of the text of a file, prepared with the options
+    of a DiffForm. It is computed once, and kept in the cache, as is
+    the prepared file, which the diffs reuse. Returns False if the
+    file can't be prepared. The file is known by its size and
+    modification time, so that the project page doesn't read the files
+    already done."""
+    path = os.path.join(project_dir, "files", filename)
+    st = os.stat(path)
+    args = diff_args(form, path, path)
+    key = cache.key("signature", filename, str(st.st_size), str(st.st_mtime_ns),
+                    options_digest(args))
+
+    signature = cache.get(key)
+    if signature is None:
+        # A file that can't be prepared is stored as False, so it is
+        # not tried again.
+        try:
+            f = CompPP(args, cache).load_file(path)
+        except Exception:
+            signature = False
+        else:
+            signature = minhash.signature(f.text + f.footnotes)
+        cache.put(key, signature)
+
+    return signature
+
+
 class DiffForm(Form):
     extract_footnotes = BooleanField('Extract and process footnotes separately')
     suppress_proofers_notes = BooleanField('In Px/Fx versions, remove [**proofreaders notes]')
@@ -197,6 +299,15 @@ class DiffForm(Form):
     suppress_nbsp_num = BooleanField("Suppress non-breakable spaces (U+00A0) between numbers")
     regroup_split_words = BooleanField("In Px/Fx versions, regroup split wo-* *rds")
     downgrade_smart_quotes = BooleanField("Downgrade smart quotes if needed")
+    chunked_diff = BooleanField("Large books: cut into chunks diffed in parallel")
+    diff_backend = SelectField('Diff engine',
+                               choices=[('internal', "internal"),
+                                        ('dwdiff', "dwdiff")],
+                               default='internal')
+    css_backend = SelectField('Transformation CSS engine',
+                              choices=[('python', "python"),
+                                       ('xslt', "xslt")],
+                              default='python')
 
     css = TextAreaField('Transformation CSS',
                         default="""
@@ -249,9 +360,43 @@ def diffs(project_id):
         if not form.validate():
             abort(404)
 
+    args = diff_args(form, f1, f2)
+
+    # Reuse a previous diff if the files and options are the same.
+    cache = DiskCache(os.path.join(project_dir, "cache"))
+    key = diff_key(cache, args)
+
+    f1 = os.path.basename(f1)
+    f2 = os.path.basename(f2)
+
+    x = CompPP(args, cache)
+    hunks = cached_hunks(cache, key)
+    if hunks is not None:
+        err_message, counts, hunks = hunks
+        diff = diff_viewer(x, project_id, key,
+                           [("errors", err_message)] + hunks, counts)
+    else:
+        # Do diff. The files are only prepared once the top of the
+        # page is sent, and the diff follows as it is produced.
+        diff = diff_viewer(x, project_id, key,
+                           store_hunks(cache, key, x.stream_hunks()))
+
+    return stream_template('diffs.tmpl',
+                           project_id=project_id,
+                           f1=f1,
+                           f2=f2,
+                           diff=diff,
+                           usage=html_usage(f1, f2),
+                           css=diff_css(),
+                           form=form)
+
+
+def diff_args(form, f1, f2):
+    """The options of CompPP to compare two files, from a DiffForm."""
+
     # Create empty object to store our arguments
     # TODO: find an easier way than recopy all of them.
-    args = lambda: 0
+    args = argparse.Namespace()
     args.filename = [f1, f2]
     args.extract_footnotes = form.extract_footnotes.data
     args.css_smcap = form.css_smcap.data
@@ -272,30 +417,302 @@ def diffs(project_id):
     args.css_no_default = form.css_no_default.data
     args.txt_cleanup_type = form.txt_cleanup_type.data
     args.downgrade_smart_quotes = form.downgrade_smart_quotes.data
+    args.diff_backend = form.diff_backend.data
+    args.css_backend = form.css_backend.data
+    args.chunked_diff = form.chunked_diff.data
+    args.dwdiff_timeout = DWDIFF_TIMEOUT
 
     # Default value - not in form yet
     args.css_bold = None
 
-    f1 = os.path.basename(f1)
-    f2 = os.path.basename(f2)
+    return args
+
+
+def diff_key(cache, args):
+    """The key of the diff of two files with these options. The names
+    of the files matter too: they select the type of file, and whether
+    a text comes from the rounds."""
+    f1, f2 = args.filename
+    return cache.key("diff",
+                     os.path.basename(f1), file_digest(f1),
+                     os.path.basename(f2), file_digest(f2),
+                     options_digest(args))
+
+
+def page_key(cache, key, part, page):
+    return cache.key(key, part, str(page))
+
+
+def store_hunks(cache, key, hunks):
+    """Pass the items of CompPP.stream_hunks() through, and store the
+    hunks in the cache, by pages. The error message and the number of
+    hunks of each part are stored last, under key, once the diff is
+    complete."""
+    err_message = None
+    counts = dict.fromkeys(DIFF_PARTS, 0)
+    pages = dict((part, []) for part in DIFF_PARTS)
+
+    for part, hunk in hunks:
+        if part == "errors":
+            err_message = hunk
+            yield part, hunk
+            continue
+
+        pages[part].append(hunk)
+        counts[part] += 1
+        if len(pages[part]) == DIFF_PAGE_SIZE:
+            cache.put(page_key(cache, key, part, counts[part] // DIFF_PAGE_SIZE - 1), pages[part])
+            pages[part] = []
+        yield part, hunk
+
+    for part in DIFF_PARTS:
+        if pages[part]:
+            cache.put(page_key(cache, key, part, counts[part] // DIFF_PAGE_SIZE), pages[part])
+
+    cache.put(key, (err_message, counts))
+
+
+def cached_diff(cache, key):
+    """Return the error message and the number of hunks of each part
+    of a cached diff, or None if it is not in the cache. The key may
+    come from a request, so the entry is checked to be a diff."""
+    result = cache.get(key)
+    if not isinstance(result, tuple) or len(result) != 2:
+        return None
+
+    err_message, counts = result
+    if not isinstance(err_message, (str, type(None))) or not isinstance(counts, dict):
+        return None
+    if not all(isinstance(counts.get(part), int) for part in DIFF_PARTS):
+        return None
+
+    return err_message, counts
+
+
+def cached_hunks(cache, key):
+    """Return the error message, the number of hunks of each part and
+    the hunks of the first page of each part of a cached diff, or None
+    if some of it is not in the cache anymore."""
+    result = cached_diff(cache, key)
+    if result is None:
+        return None
+
+    err_message, counts = result
+    hunks = []
+    for part in DIFF_PARTS:
+        if counts[part]:
+            page = cache.get(page_key(cache, key, part, 0))
+            if page is None:
+                return None
+            hunks.extend((part, hunk) for hunk in page)
+
+    return err_message, counts, hunks
+
+
+def diff_viewer(x, project_id, key, hunks, counts=None):
+    """Generate the html of a diff, with only the first DIFF_PAGE_SIZE
+    hunks of each part, from the items of CompPP.stream_hunks(). The
+    page loads the others when needed."""
+    headers = {
+        "text": "<h2 class='sep4'>Main text</h2>",
+        "footnotes": "<h2 id='footnotes' class='sep4'>Footnotes</h2>",
+    }
+    shown = dict.fromkeys(DIFF_PARTS, 0)
+    current = None
+
+    yield "<div>"
 
-    # Do diff
-    x = CompPP(args)
     try:
-        err_message, html_content, _, _ = x.do_process()
+        for part, hunk in hunks:
+            if part == "errors":
+                if hunk:
+                    yield "<div class='sep2'><pre>{0}</pre></div>".format(hunk)
+                continue
+
+            if part != current:
+                if current is not None:
+                    yield "</div>"
+                yield headers[part]
+                yield "<div id='diff-{0}'>".format(part)
+                current = part
+
+            if shown[part] < DIFF_PAGE_SIZE:
+                yield render_hunk(hunk)
+            shown[part] += 1
     except Exception as e:
-        err_message = "<div class='error-border bbox'><p>Error(s) in one of the document:</p><p>{0}</p></div>".format(e)
-        html_content = ""
+        # Too late to put it on top. The message is text, unlike the
+        # errors of the transformation CSS.
+        if current is not None:
+            yield "</div>"
+        yield "<div class='error-border bbox'><p>Error(s) in one of the document:</p><p>{0}</p>".format(escape(str(e)))
+        if current is not None:
+            yield "<p>The diff above is incomplete, and was not kept. Reload the page to try again.</p>"
+        yield "</div>"
+        yield "</div>"
+        return
+
+    if current is not None:
+        yield "</div>"
+
+    if counts is None:
+        counts = shown
+
+    # The number of hunks is only known at the end.
+    yield "<div id='diff-summary'>" + x.diff_summary(counts["text"], counts["footnotes"]) + "</div>"
+
+    # Nothing was timed if the diff came from the cache.
+    if x.timings.stages:
+        yield x.timings.html()
+
+    yield "<script type='text/javascript'>diff_viewer({0}, {1}, {2});</script>".format(
+        json.dumps(url_for('diffs_json', project_id=project_id, key=key)),
+        json.dumps(counts), DIFF_PAGE_SIZE)
+    yield "</div>"
+
+
+@app.route('/project/<project_id>/diffs.json', methods=['GET'])
+def diffs_json(project_id):
+    """Return some hunks of a diff made by the diff page, with their
+    html."""
+
+    # Validate input
+    project_dir = check_project_id(project_id)
+    if project_dir is None:
+        abort(404)
+
+    key = request.args.get('key', '')
+    if len(key) != 64 or len(set(key)-hexnumbers):
+        abort(404)
+
+    part = request.args.get('part', '')
+    if part not in DIFF_PARTS:
+        abort(404)
+
+    offset = max(request.args.get('offset', 0, type=int), 0)
+    limit = min(max(request.args.get('limit', DIFF_PAGE_SIZE, type=int), 0), MAX_JSON_HUNKS)
+
+    # The diff may have been removed from the cache since the page
+    # was sent.
+    cache = DiskCache(os.path.join(project_dir, "cache"))
+    result = cached_diff(cache, key)
+    if result is None:
+        abort(404)
+    _, counts = result
+
+    end = min(offset + limit, counts[part])
+    hunks = []
+    for page_number in range(offset // DIFF_PAGE_SIZE, (end - 1) // DIFF_PAGE_SIZE + 1):
+        page = cache.get(page_key(cache, key, part, page_number))
+        if not isinstance(page, list):
+            abort(404)
+        start = page_number * DIFF_PAGE_SIZE
+        hunks.extend(page[max(offset - start, 0):end - start])
+
+    return jsonify(total=counts[part],
+                   offset=offset,
+                   hunks=[{"lines": hunk, "html": render_hunk(hunk)}
+                          for hunk in hunks])
 
-    return render_template('diffs.tmpl',
+
+def prepare_file(project_dir, args, filename):
+    """Prepare a file in a job. The result is kept in the
+    cache, for all the pairs of files it is part of."""
+    cache = DiskCache(os.path.join(project_dir, "cache"))
+    try:
+        CompPP(args, cache).load_file(filename)
+    except Exception:
+        # The pairs will report it.
+        pass
+
+
+def diff_pair(project_dir, args):
+    """Compare two files in a job, and store the diff in
+    the cache, like the diffs page does. Returns the error message and
+    the number of hunks of each part."""
+    cache = DiskCache(os.path.join(project_dir, "cache"))
+    key = diff_key(cache, args)
+
+    result = cached_diff(cache, key)
+    if result is None:
+        try:
+            err_message = None
+            counts = dict.fromkeys(DIFF_PARTS, 0)
+            for part, hunk in store_hunks(cache, key, CompPP(args, cache).stream_hunks()):
+                if part == "errors":
+                    err_message = hunk
+                else:
+                    counts[part] += 1
+        except Exception as e:
+            # For diffs_all, which doesn't try it again.
+            cache.put(cache.key("diff-error", key), str(e))
+            raise
+        result = err_message, counts
+
+    return result
+
+
+@app.route('/project/<project_id>/diffs_all', methods=['GET'])
+def diffs_all(project_id):
+    """Compare all the pairs of files, or of the selected files, with
+    the default options. The comparisons are queued for run_jobs.py;
+    the page shows the ones already done, and reloads itself until
+    they all are."""
+
+    # Validate input
+    project_dir = check_project_id(project_id)
+    if project_dir is None:
+        abort(404)
+
+    files_dir = os.path.join(project_dir, "files")
+    filenames = request.args.getlist('file') or os.listdir(files_dir)
+    filenames = sorted(set(secure_filename(f) for f in filenames))
+    for filename in filenames:
+        if not os.path.isfile(os.path.join(files_dir, filename)):
+            abort(404)
+
+    if len(filenames) > MAX_DIFFS_ALL_FILES:
+        return render_template('diffs_all.tmpl',
+                               project_id=project_id,
+                               filenames=filenames,
+                               max_files=MAX_DIFFS_ALL_FILES,
+                               results={},
+                               pending=False)
+
+    cache = DiskCache(os.path.join(project_dir, "cache"))
+    form = DiffForm(request.form)
+
+    # Number of hunks, or error, for each pair already compared.
+    results = {}
+    missing = []
+    for f1, f2 in combinations(filenames, 2):
+        args = diff_args(form, os.path.join(files_dir, f1), os.path.join(files_dir, f2))
+        key = diff_key(cache, args)
+        result = cached_diff(cache, key)
+        error = cache.get(cache.key("diff-error", key))
+        if result is not None:
+            results[(f1, f2)] = result[1]
+        elif isinstance(error, str):
+            results[(f1, f2)] = {"error": error}
+        else:
+            missing.append((key, args))
+
+    if missing:
+        # The files first, so they are not prepared by several pairs
+        # at the same time.
+        args = diff_args(form, None, None)
+        for path in sorted(set(f for _, pair_args in missing for f in pair_args.filename)):
+            background(project_dir,
+                       cache.key("prepare", os.path.basename(path), file_digest(path), options_digest(args)),
+                       prepare_file, project_dir, args, path)
+        for key, args in missing:
+            background(project_dir, key, diff_pair, project_dir, args)
+
+    return render_template('diffs_all.tmpl',
                            project_id=project_id,
-                           f1=f1,
-                           f2=f2,
-                           err_message=err_message,
-                           diff=html_content,
-                           usage=html_usage(f1, f2),
-                           css=diff_css(),
-                           form=form)
+                           filenames=filenames,
+                           max_files=MAX_DIFFS_ALL_FILES,
+                           results=results,
+                           pending=bool(missing))
 
 
 class LangForm(Form):
@@ -418,6 +835,17 @@ if __name__ == '__main__':
 
     app.config['UPLOAD_FOLDER'] = 'temp/uploads'
 
+    if missing_dtds():
+        print("Warning: the XHTML DTDs are missing from data/dtd; run 'make dtds'.",
+              file=sys.stderr)
+
+    # The development server runs the queued jobs itself. A deployed
+    # application relies on run_jobs.py.
+    import threading
+    import run_jobs
+    threading.Thread(target=run_jobs.run,
+                     args=(os.environ.get('OPENSHIFT_DATA_DIR', ''), 2, False),
+                     daemon=True).start()
 
     app.debug = True
     app.run()
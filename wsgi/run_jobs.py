@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# -*- coding: utf-8 -*-
+
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+"""
+Run the jobs queued by the pages of pptools, i.e. the diffs of all
+the pairs of a project, in a pool of processes. The web server processes never start any.
+
+Run it from the directory of pptools.py, with the same
+OPENSHIFT_DATA_DIR, either from cron, like
+.openshift/cron/minutely/run_jobs does on OpenShift:
+
+  */1 * * * * cd wsgi && ./run_jobs.py --once
+
+or as a service, without --once. Only one instance runs at a time;
+the others exit.
+"""
+
+import os
+import sys
+import glob
+import time
+import fcntl
+import pickle
+import logging
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+
+import pptools
+
+logger = logging.getLogger("pptools.jobs")
+
+# The functions a job may call.
+JOBS = ("prepare_file", "diff_pair")
+
+# Seconds between two looks at the queues, without --once.
+POLL_INTERVAL = 2
+
+
+def queued_jobs(data_dir):
+    """The files of the queued jobs of all the projects, by
+    priority."""
+    jobs = {}
+    for path in glob.glob(os.path.join(data_dir, "projects", "*", pptools.QUEUE_DIR, "*.job")):
+        priority = int(os.path.basename(path).split("-", 1)[0])
+        jobs.setdefault(priority, []).append(path)
+    return [jobs[priority] for priority in sorted(jobs)]
+
+
+def load_job(path):
+    """The function and arguments of a job, or None if it is not
+    valid."""
+    try:
+        with open(path, "rb") as f:
+            name, args = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+    if name not in JOBS:
+        return None
+    return getattr(pptools, name), args
+
+
+def run_queued(data_dir, pool):
+    """Run the queued jobs, each priority after the previous one.
+    Returns whether there were some. A job is removed from the queue
+    once done, so a page doesn't queue it again while it runs."""
+    batches = queued_jobs(data_dir)
+    if not batches:
+        return False
+
+    # Only the first priority: the others may get more jobs meanwhile.
+    futures = {}
+    for path in batches[0]:
+        job = load_job(path)
+        if job is None:
+            logger.warning("Invalid job %s", path)
+            os.unlink(path)
+            continue
+        fn, args = job
+        futures[pool.submit(fn, *args)] = path
+
+    wait(futures)
+    broken = False
+    for future, path in futures.items():
+        error = future.exception()
+        if error is not None:
+            logger.warning("Job %s failed: %s", os.path.basename(path), error)
+        if isinstance(error, BrokenProcessPool):
+            # Kept, to be tried again by a new pool.
+            broken = True
+            continue
+        os.unlink(path)
+
+    if broken:
+        raise BrokenProcessPool("A process of the pool died")
+    return True
+
+
+def new_pool(workers):
+    """The processes are started by a server process, not forked from
+    the threads of the development server, see pptools.py."""
+    return ProcessPoolExecutor(max_workers=workers,
+                               mp_context=multiprocessing.get_context("forkserver"))
+
+
+def run(data_dir, workers, once):
+    """Run the jobs until there are no more with once, else forever."""
+    os.makedirs(os.path.join(data_dir, "projects"), exist_ok=True)
+
+    # A lock, so that the jobs are not run twice, e.g. by a cron run
+    # that lasts longer than its interval.
+    lock = open(os.path.join(data_dir, "projects", "run_jobs.lock"), "w")
+    try:
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        logger.info("run_jobs.py already runs")
+        return
+
+    pool = new_pool(workers)
+    try:
+        while True:
+            try:
+                busy = run_queued(data_dir, pool)
+            except BrokenProcessPool:
+                # The pool can't run anything anymore.
+                pool.shutdown(wait=False)
+                pool = new_pool(workers)
+                busy = True
+            if not busy:
+                if once:
+                    break
+                time.sleep(POLL_INTERVAL)
+    finally:
+        pool.shutdown()
+        lock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the queued jobs of pptools.')
+    parser.add_argument('--data-dir', type=str, default=os.environ.get('OPENSHIFT_DATA_DIR', ''),
+                        help="Directory of the projects (default: $OPENSHIFT_DATA_DIR)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help="Number of processes (default: number of CPUs)")
+    parser.add_argument('--once', action='store_true', default=False,
+                        help="Exit once the queues are empty")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+    run(args.data_dir, args.workers, args.once)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+/*
+ * This program is free software; you can redistribute it and/or
+ * modify it under the terms of the GNU General Public License
+ * as published by the Free Software Foundation; either version 2
+ * of the License, or (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ */
+
+/*
+ * The diff page only contains the first hunks of each part of the
+ * diff. The others are fetched from url when the end of a part comes
+ * into view. counts is the number of hunks of each part.
+ */
+function diff_viewer(url, counts, page_size) {
+    // The summary is only known at the end. Move it to the top.
+    var summary = document.getElementById('diff-summary');
+    summary.parentNode.insertBefore(summary, summary.parentNode.firstChild);
+
+    ['text', 'footnotes'].forEach(function (part) {
+        var hunks = document.getElementById('diff-' + part);
+        var loaded = Math.min(counts[part], page_size);
+        if (!hunks || loaded >= counts[part]) {
+            return;
+        }
+
+        var more = document.createElement('p');
+        more.className = 'center';
+        more.textContent = 'Loading...';
+        hunks.parentNode.insertBefore(more, hunks.nextSibling);
+
+        var busy = false;
+        var observer = new IntersectionObserver(function (entries) {
+            if (busy || !entries.some(function (entry) { return entry.isIntersecting; })) {
+                return;
+            }
+
+            busy = true;
+            fetch(url + '&part=' + part + '&offset=' + loaded + '&limit=' + page_size)
+                .then(function (response) {
+                    if (!response.ok) {
+                        throw new Error(response.statusText);
+                    }
+                    return response.json();
+                })
+                .then(function (data) {
+                    hunks.insertAdjacentHTML('beforeend', data.hunks.map(function (hunk) {
+                        return hunk.html;
+                    }).join(''));
+                    loaded += data.hunks.length;
+
+                    observer.unobserve(more);
+                    if (loaded >= data.total || data.hunks.length === 0) {
+                        more.parentNode.removeChild(more);
+                    } else {
+                        // Observing again tells whether it's still in view.
+                        busy = false;
+                        observer.observe(more);
+                    }
+                })
+                .catch(function () {
+                    observer.disconnect();
+                    more.textContent = 'The rest of the diff is not available anymore. Please reload the page.';
+                });
+        }, { rootMargin: '1000px' });
+
+        observer.observe(more);
+    });
+}